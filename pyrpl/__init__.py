@@ -21,23 +21,36 @@ logger = logging.getLogger(name=__name__)
 # only show errors or warnings until userdefine log level is set up
 logger.setLevel(logging.INFO)
 
-# enable ipython QtGui support if needed
-try:
-    from IPython import get_ipython
-    IPYTHON = get_ipython()
-    IPYTHON.magic("gui qt")
-except BaseException as e:
-    logger.debug('Could not enable IPython gui support: %s.' % e)
+# event loop backend: 'qt' (default) runs everything in the Qt event loop,
+# 'asyncio' runs timers and futures on a plain asyncio event loop (uvloop
+# can be used by setting the asyncio event loop policy before importing
+# pyrpl) without creating a QApplication, e.g. for headless servers.
+import os
+LOOP_BACKEND = os.environ.get('PYRPL_LOOP_BACKEND', 'qt')
+if LOOP_BACKEND not in ['qt', 'asyncio']:
+    logger.warning("Unknown PYRPL_LOOP_BACKEND %s, using 'qt' instead.",
+                   LOOP_BACKEND)
+    LOOP_BACKEND = 'qt'
 
-# get QApplication instance
-from qtpy import QtCore, QtWidgets
-APP = QtWidgets.QApplication.instance()
-if APP is None:
-    logger.debug('Creating new QApplication instance "pyrpl"')
-    APP = QtWidgets.QApplication(['pyrpl'])
+if LOOP_BACKEND == 'qt':
+    # enable ipython QtGui support if needed
+    try:
+        from IPython import get_ipython
+        IPYTHON = get_ipython()
+        IPYTHON.magic("gui qt")
+    except BaseException as e:
+        logger.debug('Could not enable IPython gui support: %s.' % e)
+
+    # get QApplication instance
+    from qtpy import QtCore, QtWidgets
+    APP = QtWidgets.QApplication.instance()
+    if APP is None:
+        logger.debug('Creating new QApplication instance "pyrpl"')
+        APP = QtWidgets.QApplication(['pyrpl'])
+else:
+    APP = None  # no gui with the asyncio backend
 
 # get user directories
-import os
 try:  # first try from environment variable
     user_dir = os.environ["PYRPL_USER_DIR"]
 except KeyError:  # otherwise, try ~/pyrpl_user_dir (where ~ is the user's home dir)
@@ -8,8 +8,10 @@ a Pyrpl instance with the config file
 import sys
 try:
     from pyrpl import Pyrpl, APP
+    from pyrpl import async_utils
 except:
     from . import Pyrpl, APP
+    from . import async_utils
 
 if __name__ == '__main__':
     if len(sys.argv) > 3:
@@ -35,4 +37,7 @@ if __name__ == '__main__':
 
     print("Calling Pyrpl(**%s)"%str(kwargs))
     PYRPL = Pyrpl(**kwargs)
-    APP.exec_()
+    if APP is not None:
+        APP.exec_()
+    else:  # asyncio loop backend
+        async_utils.LOOP.run_forever()
@@ -44,14 +44,171 @@ Example:
         eventloop.run_until_complete()
 """
 from copy import copy
+from collections import OrderedDict
+from timeit import default_timer
+import threading
+try:
+    import queue
+except ImportError:  # python 2.7
+    import Queue as queue
+import numpy as np
 from .module_attributes import *
-from .async_utils import PyrplFuture, Future, MainThreadTimer, CancelledError
+from .async_utils import PyrplFuture, Future, MainThreadTimer, \
+    CancelledError, call_in_main_thread, call_in_main_thread_and_wait
 
 
 class AcquisitionError(ValueError):
     pass
 
 
+class AcquisitionThread(threading.Thread):
+    """
+    Background thread of an AcquisitionModule that waits for the curves to
+    be ready in the hardware and fetches them.
+
+    Jobs (CurveFuture for single curves, RunAcquisition for averaged runs)
+    are submitted with submit() and executed one after the other. For each
+    curve, wait_for_curve() sleeps for module._remaining_time(), then polls
+    module._data_ready() every POLL_INTERVAL seconds and finally calls
+    module._get_curve(). The results are handed over to the event loop
+    with call_in_main_thread(). The event loop is thus not blocked by the
+    transfer and processing, and does not have to poll the instrument with
+    timers, such that the acquisition rate is only limited by the hardware.
+    """
+    POLL_INTERVAL = 0.2e-3  # seconds
+
+    def __init__(self, module):
+        super(AcquisitionThread, self).__init__(
+            name="%s acquisition" % module.name)
+        self.daemon = True
+        self._module = module
+        self._queue = queue.Queue()
+
+    def submit(self, job):
+        self._queue.put(job)
+
+    def stop(self):
+        self._queue.put(None)
+
+    def run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job._run_in_thread(self)
+
+    def wait_for_curve(self, job, delay=None, out=None):
+        """
+        returns the next curve, or None if the job was cancelled. Polling
+        starts after delay seconds (module._remaining_time() if None). If
+        out is given, the curve is written into this array (see
+        AcquisitionModule._get_curve_into_out).
+        """
+        module = self._module
+        if delay is None:
+            delay = module._remaining_time()
+        if job._aborted.wait(max(0, delay)):
+            return None
+        while not module._data_ready():
+            if job._aborted.wait(self.POLL_INTERVAL):
+                return None
+        if job._aborted.is_set():
+            return None
+        if out is not None:
+            return module._get_curve(out=out)
+        return module._get_curve()
+
+
+class TripleBuffer(object):
+    """
+    Hands arrays over from a writer thread to a reader thread without
+    copies or allocations.
+
+    Each of the 3 slots holds arrays created by create(). The writer fills
+    the arrays of back and calls publish(). read() returns the most
+    recently published slot, which is not written to until the next
+    call of read(), while the writer always has a free slot.
+    """
+    def __init__(self, create):
+        self._slots = [create() for i in range(3)]
+        self._back, self._latest, self._reading = 0, 1, 2
+        self._new = False
+        self._lock = threading.Lock()
+
+    @property
+    def back(self):
+        return self._slots[self._back]
+
+    def publish(self):
+        with self._lock:
+            self._back, self._latest = self._latest, self._back
+            self._new = True
+
+    def read(self):
+        with self._lock:
+            if self._new:
+                self._reading, self._latest = self._latest, self._reading
+                self._new = False
+            return self._slots[self._reading]
+
+
+class RunAcquisition(object):
+    """
+    Acquires and averages the curves of a RunFuture in the
+    AcquisitionThread, until the run is over or the acquisition cancelled.
+
+    The job starts the first curve with module._start_acquisition() in the
+    main thread once the thread gets to it, i.e. only after the previous
+    job (e.g. a paused run that was still fetching a curve) has returned.
+    The following curves are re-armed by the thread with
+    module._rearm_acquisition() as soon as a curve has been fetched, or
+    with module._start_acquisition() in the main thread for modules that
+    cannot be re-armed by only writing registers (see _rearm_in_thread).
+    Curves that were being fetched while the job was cancelled are
+    discarded.
+    Since the curves are copied into the average, all curves of the run
+    are fetched into the array of the first one if the module supports it
+    (see _get_curve_into_out).
+    """
+    def __init__(self, run_future):
+        self._run_future = run_future
+        self._aborted = threading.Event()
+
+    def cancel(self):
+        self._aborted.set()
+
+    def _start_acquisition(self):
+        """ starts a curve (in the main thread), unless the job has been
+        cancelled in the meantime """
+        if not self._aborted.is_set():
+            self._run_future._module._start_acquisition()
+
+    def _run_in_thread(self, thread):
+        run = self._run_future
+        module = run._module
+        delay = None
+        out = None
+        try:
+            call_in_main_thread_and_wait(self._start_acquisition)
+            while True:
+                curve = thread.wait_for_curve(self, delay, out=out)
+                if curve is None or self._aborted.is_set():
+                    return  # the curve may be torn by a restart
+                if module._get_curve_into_out:
+                    out = curve
+                run._add_curve(curve)
+                run._notify()
+                if run._is_run_over() or self._aborted.is_set():
+                    return
+                if module._rearm_in_thread:
+                    delay = module._rearm_acquisition()
+                else:
+                    call_in_main_thread_and_wait(self._start_acquisition)
+                    delay = None
+        except Exception as e:
+            call_in_main_thread(run._set_exception_from_thread, e)
+
+
 class CurveFuture(PyrplFuture):
     """
     The basic acquisition of instruments is an asynchronous process:
@@ -62,7 +219,10 @@ class CurveFuture(PyrplFuture):
     we want the event loop to stay alive while waiting for a pending curve.
     That's the purpose of this future object.
 
-    After its creation, it will perform the following actions:
+    If module._threaded_acquisition is True, the future is submitted to
+    the AcquisitionThread of the module, which waits for the curve and
+    fetches it in the background (see AcquisitionThread). Otherwise, it
+    will perform the following actions in the event loop:
 
         1. stay inactive for a time given by instrument._remaining_time()
         2. after that, it will check every min_refresh_delay if a new curve is ready with instrument._data_ready()
@@ -73,9 +233,14 @@ class CurveFuture(PyrplFuture):
     def __init__(self, module, min_delay_ms=20):
         self._module = module
         self.min_delay_ms = min_delay_ms
+        self._aborted = threading.Event()  # tells the thread to give up
+        self._timer = None
         super(CurveFuture, self).__init__()
-        self._init_timer()
         self._module._start_acquisition()
+        if self._module._threaded_acquisition:
+            self._module._acquisition_thread.submit(self)
+        else:
+            self._init_timer()
 
     def _init_timer(self):
         if self.min_delay_ms == 0:
@@ -97,22 +262,44 @@ class CurveFuture(PyrplFuture):
         else:
             return None
 
+    def _run_in_thread(self, thread):
+        try:
+            data = thread.wait_for_curve(self)
+        except Exception as e:
+            call_in_main_thread(self._set_exception_from_thread, e)
+        else:
+            if data is not None:
+                call_in_main_thread(self._set_curve, data)
+
     def _set_data_as_result(self):
         data = self._get_one_curve()
         if data is not None:
-            self.set_result(data)
-            if self._module.running_state in ["paused", "stopped"]:
-                self._module._free_up_resources()
+            self._set_curve(data)
         else:
             self._timer.setInterval(self.min_delay_ms)
             self._timer.start()
 
+    def _set_curve(self, data):
+        if self.done():  # cancelled while the curve was handed over
+            return
+        self.set_result(data)
+        if self._module.running_state in ["paused", "stopped"]:
+            self._module._free_up_resources()
+
+    def _set_exception_from_thread(self, exception):
+        if not self.done():
+            self.set_exception(exception)
+
     def set_exception(self, exception):  # pragma: no cover
-        self._timer.stop()
+        self._aborted.set()
+        if self._timer is not None:
+            self._timer.stop()
         super(CurveFuture, self).set_exception(exception)
 
     def cancel(self):
-        self._timer.stop()
+        self._aborted.set()
+        if self._timer is not None:
+            self._timer.stop()
         super(CurveFuture, self).cancel()
 
 
@@ -134,6 +321,21 @@ class RunFuture(PyrplFuture):
     - Specan or NA:
         - data_x  : frequencies
         - data_avg: np.array(y_complex)
+
+    The average is accumulated in-place in preallocated arrays, i.e.
+    data_avg changes while the run is going on (copy it to keep a
+    snapshot). Depending on module.average_mode, the average in continuous
+    mode is either exponential with weight 1/trace_average ('exponential')
+    or the exact average of the last trace_average curves, kept in a ring
+    buffer ('moving_window'). If module.compute_variance is True, data_var
+    holds the variance of the averaged curves (Welford's algorithm).
+
+    If module._threaded_acquisition is True, the curves are acquired,
+    fetched and averaged in the AcquisitionThread of the module without
+    waiting for the event loop (see RunAcquisition). The thread publishes
+    a copy of data_avg and data_var in a TripleBuffer after each curve
+    and notifies the event loop, which displays the latest curve. Thus,
+    the acquisition rate does not depend on the display.
     """
 
     def __init__(self, module, min_delay_ms):
@@ -141,11 +343,33 @@ class RunFuture(PyrplFuture):
         self._module = module
         self._min_delay_ms = min_delay_ms
         super(RunFuture, self).__init__()
-        self.data_avg = None
-        self.data_x = copy(self._module.data_x) #  in case it is saved later
+        self._data_avg = None
+        self._data_var = None
+        data_x = self._module.data_x
+        if isinstance(data_x, np.ndarray) and not data_x.flags.writeable:
+            self.data_x = data_x  # read-only (e.g. cached) axes never change
+        else:
+            self.data_x = copy(data_x) #  in case it is saved later
         self._fut = None
         self.current_avg = 0
         self._paused = True
+        self._threaded = self._module._threaded_acquisition
+        self._buffer = None  # TripleBuffer of published (data_avg, data_var)
+        self._notify_pending = False
+
+    @property
+    def data_avg(self):
+        """ the averaged curve """
+        if not self._threaded:
+            return self._data_avg
+        return None if self._buffer is None else self._buffer.read()[0]
+
+    @property
+    def data_var(self):
+        """ the variance of the averaged curves (see compute_variance) """
+        if not self._threaded:
+            return self._data_var
+        return None if self._buffer is None else self._buffer.read()[1]
 
     def _new_curve_arrived(self, curve):
         try:
@@ -158,14 +382,7 @@ class RunFuture(PyrplFuture):
                 self.cancel()
         if self._module.running_state in ["running_continuous",
                                           "running_single"]:
-            self.current_avg = min(self.current_avg + 1,
-                                   self._module.trace_average)
-
-            if self.data_avg is None:
-                self.data_avg = result
-            else:
-                self.data_avg = (self.data_avg * (self.current_avg - 1) +
-                                 result) / self.current_avg
+            self._add_curve(result)
 
             self._module._emit_signal_by_name('display_curve',
                                               [self._module.data_x,
@@ -182,6 +399,141 @@ class RunFuture(PyrplFuture):
                 if not self._paused:
                     self.start()
 
+    def _add_curve(self, curve):
+        """ adds a curve to the average and publishes the result """
+        self.current_avg = min(self.current_avg + 1,
+                               self._module.trace_average)
+        self._accumulate(curve)
+        if self._threaded:
+            self._publish()
+
+    def _publish(self):
+        """
+        copies the average into the TripleBuffer read by data_avg and
+        data_var (called by the acquisition thread)
+        """
+        buffer = self._buffer
+        if buffer is None or buffer.back[0].shape != self._data_avg.shape \
+                or buffer.back[0].dtype != self._data_avg.dtype \
+                or (buffer.back[1] is None) != (self._data_var is None):
+            buffer = TripleBuffer(lambda: (
+                np.empty_like(self._data_avg),
+                None if self._data_var is None
+                else np.empty_like(self._data_var)))
+        avg, var = buffer.back
+        np.copyto(avg, self._data_avg)
+        if var is not None:
+            np.copyto(var, self._data_var)
+        buffer.publish()
+        self._buffer = buffer
+
+    def _notify(self):
+        """
+        tells the event loop that a new average is available (called by the
+        acquisition thread). Notifications are not queued up if the event
+        loop is busy, it will simply display the latest average.
+        """
+        if not self._notify_pending:
+            self._notify_pending = True
+            call_in_main_thread(self._curve_published)
+
+    def _curve_published(self):
+        self._notify_pending = False
+        if self.done() or self._module.running_state not in [
+                "running_continuous", "running_single"]:
+            return
+        self._module._emit_signal_by_name('display_curve',
+                                          [self._module.data_x,
+                                           self.data_avg])
+        if self._is_run_over():
+            self.set_result(self.data_avg)
+            self._module.running_state = "stopped"  # see _new_curve_arrived
+
+    def _set_exception_from_thread(self, exception):
+        self._module._logger.error("Error during the acquisition of %s: %s",
+                                   self._module.name, exception)
+        if not self.done():
+            self.set_exception(exception)
+
+    def _init_accumulators(self, shape, dtype):
+        if dtype.kind not in 'fc':
+            dtype = np.dtype(np.float64)
+        real_dtype = np.zeros(1, dtype=dtype).real.dtype
+        self._data_avg = np.zeros(shape, dtype=dtype)
+        self._delta = np.empty(shape, dtype=dtype)
+        self._square = np.empty(shape, dtype=real_dtype)
+        if self._module.compute_variance:
+            self._data_var = np.zeros(shape, dtype=real_dtype)
+        else:
+            self._data_var = None
+        if self._module.average_mode == 'moving_window':
+            self._window = np.zeros((self._module.trace_average,) + shape,
+                                    dtype=dtype)
+            self._window_index = 0
+            self._window_count = 0
+            self._sum = np.zeros(shape, dtype=dtype)
+            if self._data_var is not None:
+                self._sum_squares = np.zeros(shape, dtype=real_dtype)
+        else:
+            self._window = None
+        self.current_avg = 1
+
+    def _abs_squared(self, data):
+        """ returns abs(data)**2 in the preallocated array self._square """
+        np.abs(data, out=self._square)
+        return np.multiply(self._square, self._square, out=self._square)
+
+    def _accumulate(self, result):
+        """ adds the curve result to the average """
+        result = np.asarray(result)
+        if self._data_avg is None or self._data_avg.shape != result.shape or \
+                (self._module.average_mode == 'moving_window') != \
+                (self._window is not None) or \
+                (self._window is not None and
+                 len(self._window) != self._module.trace_average):
+            self._init_accumulators(result.shape, result.dtype)
+        if self._window is not None:
+            self._accumulate_window(result)
+        else:
+            # exponential (cumulative until trace_average curves) average
+            n = self.current_avg
+            delta = np.subtract(result, self._data_avg, out=self._delta)
+            if self._data_var is not None:
+                # var_n = (1 - 1/n) * (var_n-1 + |delta|**2 / n)
+                square = self._abs_squared(delta)
+                square /= n
+                self._data_var += square
+                self._data_var *= (n - 1.) / n
+            delta /= n
+            self._data_avg += delta
+
+    def _accumulate_window(self, result):
+        """ exact average of the last trace_average curves """
+        window, index = self._window, self._window_index
+        if self._window_count == len(window):  # remove the oldest curve
+            self._sum -= window[index]
+            if self._data_var is not None:
+                self._sum_squares -= self._abs_squared(window[index])
+        else:
+            self._window_count += 1
+        window[index] = result
+        self._sum += window[index]
+        if self._data_var is not None:
+            self._sum_squares += self._abs_squared(window[index])
+        self._window_index = (index + 1) % len(window)
+        if self._window_index == 0:
+            # avoid accumulation of rounding errors in the running sums
+            np.sum(window, axis=0, out=self._sum)
+            if self._data_var is not None:
+                np.sum(np.abs(window) ** 2, axis=0, out=self._sum_squares)
+        n = self._window_count
+        np.divide(self._sum, n, out=self._data_avg)
+        if self._data_var is not None:
+            # var = <|x|**2> - |<x>|**2
+            np.divide(self._sum_squares, n, out=self._data_var)
+            self._data_var -= self._abs_squared(self._data_avg)
+            np.maximum(self._data_var, 0, out=self._data_var)
+
     def _is_run_over(self):
         if self._run_continuous:
             return False
@@ -194,16 +546,21 @@ class RunFuture(PyrplFuture):
 
     def pause(self):
         self._paused = True
-        self._module._free_up_resources()
         if self._fut is not None:
             self._fut.cancel()
+        self._module._free_up_resources()
 
     def start(self):
         self._paused = False
         if self._fut is not None:
             self._fut.cancel()
-        self._fut = self._module._curve_async(self._min_delay_ms)
-        self._fut.add_done_callback(self._new_curve_arrived)
+        if self._threaded:
+            # the acquisition is started by the job (see RunAcquisition)
+            self._fut = RunAcquisition(self)
+            self._module._acquisition_thread.submit(self._fut)
+        else:
+            self._fut = self._module._curve_async(self._min_delay_ms)
+            self._fut.add_done_callback(self._new_curve_arrived)
 
     def _set_run_continuous(self):
         """
@@ -279,6 +636,46 @@ class SignalLauncherAcquisitionModule(SignalLauncher):
     # Following signal only implemented in spec an
     unit_changed = QtCore.Signal()
 
+    # Display updates are coalesced: if they arrive faster than
+    # module.max_display_rate, only the latest one is emitted (the
+    # widgets always display the latest data of the module).
+    _coalesced_signals = ['display_curve', 'update_point']
+
+    def __init__(self, module):
+        super(SignalLauncherAcquisitionModule, self).__init__(module)
+        self._pending = OrderedDict()  # signal name -> latest (args, kwds)
+        self._last_display_time = 0
+        self._display_timer = MainThreadTimer(0)
+        self._display_timer.timeout.connect(self._flush_display)
+
+    def emit_signal_by_name(self, name, *args, **kwds):
+        if name in self._coalesced_signals:
+            self._pending[name] = (args, kwds)
+            if not self._display_timer.isActive():
+                delay = self._last_display_time - default_timer() + \
+                        1. / self.module.max_display_rate
+                self._display_timer.setInterval(int(max(0, delay * 1000)))
+                self._display_timer.start()
+        else:
+            self._flush_display()  # preserve the order of the signals
+            super(SignalLauncherAcquisitionModule, self).emit_signal_by_name(
+                name, *args, **kwds)
+
+    def _flush_display(self):
+        """ emits the pending display updates right away """
+        self._display_timer.stop()
+        if not self._pending:
+            return
+        while self._pending:
+            name, (args, kwds) = self._pending.popitem(last=False)
+            getattr(self, name).emit(*args, **kwds)
+        self._last_display_time = default_timer()
+
+    def _clear(self):
+        self._display_timer.stop()
+        self._pending.clear()
+        super(SignalLauncherAcquisitionModule, self)._clear()
+
 
 class AcquisitionModule(Module):
     """
@@ -345,6 +742,15 @@ class AcquisitionModule(Module):
     # possible
     MIN_DELAY_CONTINUOUS_MS = 40  # leave time for the event loop in
     # continuous
+    _threaded_acquisition = False  # True if curves are awaited and fetched
+    # by an AcquisitionThread instead of timers in the event loop (the
+    # MIN_DELAY_..._MS are then irrelevant). Only for modules whose
+    # _data_ready() and _get_curve() are safe to call from another thread.
+    _rearm_in_thread = False  # True if the module implements
+    # _rearm_acquisition(), which the AcquisitionThread calls between the
+    # curves of a run
+    _get_curve_into_out = False  # True if _get_curve(out=array) writes the
+    # curve into a preallocated array and returns it
 
     running_state = RunningStateProperty(
         default='stopped',
@@ -356,6 +762,22 @@ class AcquisitionModule(Module):
                            "performed.",
                            default=1,
                            min=1)
+    average_mode = SelectProperty(options=['exponential', 'moving_window'],
+                                  default='exponential',
+                                  doc="averaging in continuous mode: "
+                                      "'exponential' weighs each new curve "
+                                      "with 1/trace_average, "
+                                      "'moving_window' is the exact average "
+                                      "of the last trace_average curves.")
+    compute_variance = BoolProperty(default=False,
+                                    doc="if True, the variance of the "
+                                        "averaged curves is available in "
+                                        "data_var.")
+    max_display_rate = FloatProperty(default=25., min=0.1, max=1000.,
+                                     doc="maximum rate (Hz) of display "
+                                         "updates. Acquisition continues at "
+                                         "full speed, intermediate curves "
+                                         "are not displayed.")
     curve_name = StringProperty(doc="name of the curve to save.")
 
     def __init__(self, parent, name=None):
@@ -371,6 +793,16 @@ class AcquisitionModule(Module):
         # at instanciation.
 
 
+    @property
+    def _acquisition_thread(self):
+        """ the AcquisitionThread of the module, started on first use """
+        thread = getattr(self, '_acquisition_thread_instance', None)
+        if thread is None or not thread.is_alive():
+            thread = AcquisitionThread(self)
+            thread.start()
+            self._acquisition_thread_instance = thread
+        return thread
+
     def _new_curve_future(self, min_delay_ms):
         self._curve_future.cancel()
         self._curve_future = self._curve_future_cls(self,
@@ -480,6 +912,9 @@ class AcquisitionModule(Module):
         super(AcquisitionModule, self)._clear()
         self._curve_future.cancel()
         self._run_future.cancel()
+        thread = getattr(self, '_acquisition_thread_instance', None)
+        if thread is not None:
+            thread.stop()
 
     def _setup(self):
         # the _run_future is renewed to match the requested type of run (
@@ -535,6 +970,18 @@ class AcquisitionModule(Module):
         """
         pass  # pragma: no cover
 
+    def _rearm_acquisition(self):
+        """
+        Re-arms the acquisition of the next curve of a run with the
+        settings of the last call to _start_acquisition(). This function is
+        called from the AcquisitionThread (if _rearm_in_thread is True),
+        hence it may only write registers, but must not change attributes
+        of the module or emit signals.
+
+        :return: time in seconds before the new curve can be ready.
+        """
+        raise NotImplementedError("To implement in derived class")  # pragma: no cover
+
     def _free_up_resources(self):
         pass # pragma: no cover
 
@@ -545,6 +992,10 @@ class AcquisitionModule(Module):
     def data_avg(self):
         return self._run_future.data_avg
 
+    @property
+    def data_var(self):
+        return self._run_future.data_var
+
     @property
     def current_avg(self):
         return self._run_future.current_avg
@@ -1,13 +1,26 @@
 """
 This file contains a number of methods for asynchronous operations.
+
+Two event loop backends are available (see LOOP_BACKEND in pyrpl/__init__.py,
+selected with the environment variable PYRPL_LOOP_BACKEND):
+
+- 'qt': the Qt event loop of APP drives everything, asyncio coroutines run
+  on top of it through quamash.
+- 'asyncio': timers, futures and hand-overs from other threads run on a
+  plain asyncio event loop (LOOP), no QApplication is created. Blocking
+  functions (sleep, await_result) run LOOP until they return, or must be
+  replaced by coroutines (await asyncio.sleep(), await future) if LOOP is
+  already running.
 """
 import logging
+import threading
+import time
 from qtpy import QtCore, QtWidgets
 from timeit import default_timer
 logger = logging.getLogger(name=__name__)
 
 from . import APP  # APP is only created once at the startup of PyRPL
-MAIN_THREAD = APP.thread()
+from . import LOOP_BACKEND
 
 try:
     from asyncio import Future, ensure_future, CancelledError, \
@@ -16,9 +29,22 @@ except ImportError:  # this occurs in python 2.7
     logger.debug("asyncio not found, we will use concurrent.futures "
                   "instead of python 3.5 Futures.")
     from concurrent.futures import Future, CancelledError, TimeoutError
+    if LOOP_BACKEND == 'asyncio':
+        raise ImportError("The asyncio loop backend requires python 3.")
+else:
+    import asyncio
+    if LOOP_BACKEND == 'qt':
+        import quamash
+        set_event_loop(quamash.QEventLoop())
+    else:
+        # uses the event loop policy, e.g. uvloop.EventLoopPolicy()
+        LOOP = asyncio.new_event_loop()
+        set_event_loop(LOOP)
+
+if LOOP_BACKEND == 'qt':
+    MAIN_THREAD = APP.thread()
 else:
-    import quamash
-    set_event_loop(quamash.QEventLoop())
+    MAIN_THREAD = threading.current_thread()
 
 
 
@@ -96,6 +122,201 @@ class MainThreadTimer(QtCore.QTimer):
         self.setSingleShot(True)
         self.setInterval(interval)
 
+    def setInterval(self, interval):
+        # QTimer only accepts an integer number of milliseconds
+        super(MainThreadTimer, self).setInterval(int(round(interval)))
+
+
+class MainThreadCaller(QtCore.QObject):
+    """
+    Hands function calls over from any thread to the main thread.
+
+    A signal emitted from a foreign thread is delivered through the event
+    queue of the main thread (queued connection), such that the function
+    is executed by the event loop of the main thread as soon as possible.
+    This is the thread-safe way to set the result of a future from a
+    background thread.
+    """
+    _call = QtCore.Signal(object)
+
+    def __init__(self):
+        super(MainThreadCaller, self).__init__()
+        self.moveToThread(MAIN_THREAD)
+        self._call.connect(self._execute, QtCore.Qt.QueuedConnection)
+
+    def _execute(self, call):
+        func, args = call
+        func(*args)
+
+    def call(self, func, *args):
+        self._call.emit((func, args))
+
+
+class TimerSignal(object):
+    """
+    Replacement of the timeout signal of QTimer for AsyncioTimer.
+    """
+    def __init__(self):
+        self._slots = []
+
+    def connect(self, slot):
+        self._slots.append(slot)
+
+    def disconnect(self, slot=None):
+        if slot is None:
+            self._slots = []
+        else:
+            self._slots.remove(slot)
+
+    def emit(self):
+        for slot in list(self._slots):
+            slot()
+
+
+class AsyncioTimer(object):
+    """
+    Timer of the asyncio backend with the same interface as
+    MainThreadTimer (interval in ms, single shot by default). The timer is
+    always scheduled in the main thread, i.e. in the thread of LOOP.
+    """
+    def __init__(self, interval):
+        self.timeout = TimerSignal()
+        self.setInterval(interval)
+        self._single_shot = True
+        self._handle = None
+
+    def interval(self):
+        return int(self._interval)
+
+    def setInterval(self, interval):
+        self._interval = int(round(interval))  # ms, as in QTimer
+
+    def isSingleShot(self):
+        return self._single_shot
+
+    def setSingleShot(self, single_shot):
+        self._single_shot = single_shot
+
+    def isActive(self):
+        return self._handle is not None
+
+    def start(self, interval=None):
+        if interval is not None:
+            self.setInterval(interval)
+        if _in_main_thread():
+            self._schedule()
+        else:
+            LOOP.call_soon_threadsafe(self._schedule)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        self.stop()
+        self._handle = LOOP.call_later(max(0, self._interval) / 1000.,
+                                       self._timeout)
+
+    def _timeout(self):
+        self._handle = None
+        if not self._single_shot:
+            self._schedule()
+        self.timeout.emit()
+
+
+class AsyncioCaller(object):
+    """
+    Hands function calls over from any thread to LOOP (asyncio backend).
+    """
+    def call(self, func, *args):
+        LOOP.call_soon_threadsafe(func, *args)
+
+
+def _in_main_thread():
+    if LOOP_BACKEND == 'qt':
+        return QtCore.QThread.currentThread() == MAIN_THREAD
+    else:
+        return threading.current_thread() is MAIN_THREAD
+
+
+def process_events():
+    """
+    Processes the pending events of the event loop once.
+    """
+    if LOOP_BACKEND == 'qt':
+        APP.processEvents()
+    elif not LOOP.is_running():
+        LOOP.run_until_complete(asyncio.sleep(0))
+
+
+def _run_loop(delay):
+    """
+    Runs the event loop for delay seconds (at Qt timer precision).
+    """
+    if LOOP_BACKEND == 'asyncio':
+        if LOOP.is_running():  # cannot run a nested loop
+            time.sleep(delay)
+        else:
+            LOOP.run_until_complete(asyncio.sleep(delay))
+        return
+    loop = QtCore.QEventLoop()
+    timer = MainThreadTimer(delay * 1000)
+    timer.timeout.connect(loop.quit)
+    timer.start()
+    try:
+        loop.exec_()
+    except KeyboardInterrupt as e:  # pragma: no-cover
+        # try to recover from KeyboardInterrupt by finishing the current task
+        timer.setInterval(1)
+        timer.start()
+        loop.exec_()
+        raise e
+
+
+# the asyncio backend uses the asyncio implementations (like CurveDB with
+# the sqlite backend in curvedb.py)
+if LOOP_BACKEND == 'asyncio':
+    MainThreadTimer = AsyncioTimer
+    MainThreadCaller = AsyncioCaller
+
+MAIN_THREAD_CALLER = MainThreadCaller()
+
+
+def call_in_main_thread(func, *args):
+    """
+    Executes func(*args) in the main thread at the next iteration of the
+    event loop. May be called from any thread, returns immediately.
+    """
+    MAIN_THREAD_CALLER.call(func, *args)
+
+
+def call_in_main_thread_and_wait(func, *args):
+    """
+    Executes func(*args) in the main thread and returns its result (or
+    raises its exception) in the calling thread, which is blocked in the
+    meantime. Must not be used while the main thread waits for the
+    calling thread.
+    """
+    if _in_main_thread():
+        return func(*args)
+    done = threading.Event()
+    outcome = []
+
+    def call():
+        try:
+            outcome.append((True, func(*args)))
+        except BaseException as e:
+            outcome.append((False, e))
+        finally:
+            done.set()
+    call_in_main_thread(call)
+    done.wait()
+    success, value = outcome[0]
+    if not success:
+        raise value
+    return value
+
 
 class PyrplFuture(Future):
     """
@@ -153,20 +374,35 @@ class PyrplFuture(Future):
         """
         if self.cancelled():
             raise CancelledError("Future was cancelled")  # pragma: no-cover
+        if LOOP_BACKEND == 'asyncio':
+            return self._wait_for_done_asyncio(timeout)
         if not self.done():
-            self.timer_timeout = None
+            self._timer_timeout = None
             if (timeout is not None) and timeout > 0:
                 self._timer_timeout = MainThreadTimer(timeout*1000)
                 self._timer_timeout.timeout.connect(self._exit_loop)
                 self._timer_timeout.start()
             self.loop = QtCore.QEventLoop()
             self.add_done_callback(self._exit_loop)
-            self.loop.exec_()
+            if not self.done():  # quit() before exec_() would be lost
+                self.loop.exec_()
             if self._timer_timeout is not None:
-                if not self._timer_timeout.isActive():
-                    return TimeoutError("Timeout occured")  # pragma: no-cover
-                else:
-                    self._timer_timeout.stop()
+                self._timer_timeout.stop()
+            if not self.done():
+                raise TimeoutError("Timeout occured")  # pragma: no-cover
+
+    def _wait_for_done_asyncio(self, timeout):
+        if self.done():
+            return
+        if LOOP.is_running():
+            raise RuntimeError("Cannot block in the running asyncio event "
+                               "loop, use 'await future' instead of "
+                               "future.await_result().")
+        if timeout is not None and timeout <= 0:
+            timeout = None  # same as the qt backend
+        LOOP.run_until_complete(asyncio.wait([self], timeout=timeout))
+        if not self.done():
+            raise TimeoutError("Timeout occured")  # pragma: no-cover
 
     def await_result(self, timeout=None):
         """
@@ -227,35 +463,79 @@ class PyrplFuture(Future):
         super(PyrplFuture, self).cancel()
 
 
-def sleep(delay):
+SLEEP_MODES = ['precise', 'coarse', 'spin']
+SLEEP_SLICE = 2e-4  # maximum duration (s) of system sleeps in precise mode
+sleep_mode = None  # read from global_config at the first call of sleep()
+
+
+def _get_sleep_mode():
+    global sleep_mode
+    if sleep_mode is None:
+        try:
+            from . import global_config
+            sleep_mode = global_config.general.sleep_mode
+        except:
+            sleep_mode = 'precise'
+        if sleep_mode not in SLEEP_MODES:
+            logger.warning("Unknown sleep_mode %s in global_config, using "
+                           "'precise' instead.", sleep_mode)
+            sleep_mode = 'precise'
+    return sleep_mode
+
+
+def set_sleep_mode(mode):
+    """
+    Selects the strategy of sleep() for the last millisecond of a delay:
+
+        * 'precise': events are processed in between system sleeps of at most SLEEP_SLICE seconds (clock_nanosleep on linux). Precision of ~0.1 ms at a negligible CPU load.
+        * 'coarse': no special treatment, the Qt timer precision of ~1 ms is accepted. Lowest CPU load.
+        * 'spin': events are processed in a busy loop. Precision in the microsecond range, but one CPU core is used at 100 % during the last millisecond of every sleep.
+    """
+    global sleep_mode
+    if mode not in SLEEP_MODES:
+        raise ValueError("sleep mode must be one of %s, got %s"
+                         % (SLEEP_MODES, mode))
+    sleep_mode = mode
+
+
+def sleep(delay, mode=None):
     """
     Sleeps for :code:`delay` seconds + runs the event loop in the background.
 
         * This function will never return until the specified delay in seconds is elapsed.
         * During the execution of this function, the qt event loop (== asyncio event-loop in pyrpl) continues to process events from the gui, or from other coroutines.
-        * Contrary to time.sleep() or async.sleep(), this function will try to achieve a precision much better than 1 millisecond (of course, occasionally, the real delay can be longer than requested), but on average, the precision is in the microsecond range.
+        * Contrary to time.sleep() or async.sleep(), this function will try to achieve a precision much better than 1 millisecond (of course, occasionally, the real delay can be longer than requested), but on average, the precision is in the microsecond range ('spin') or about 0.1 ms ('precise').
         * Finally, care has been taken to use low level system-functions to reduce CPU-load when no events need to be processed.
 
+    The strategy for the last millisecond is given by mode, or by the
+    global sleep_mode if mode is None (see set_sleep_mode()).
+
     More details on the implementation can be found on the page: `<https://github.com/lneuhaus/pyrpl/wiki/Benchmark-asynchronous-sleep-functions>`_.
     """
     tic = default_timer()
     end_time = tic + delay
+    if mode is None:
+        mode = _get_sleep_mode()
 
-    # 1. CPU-free sleep for delay - 1ms
-    if delay > 1e-3:
+    # 1. CPU-free sleep for delay - 1ms (the whole delay in coarse mode)
+    if mode == 'coarse':
+        new_delay = delay
+    else:
         new_delay = delay - 1e-3
-        loop = QtCore.QEventLoop()
-        timer = MainThreadTimer(new_delay * 1000)
-        timer.timeout.connect(loop.quit)
-        timer.start()
-        try:
-            loop.exec_()
-        except KeyboardInterrupt as e:  # pragma: no-cover
-            # try to recover from KeyboardInterrupt by finishing the current task
-            timer.setInterval(1)
-            timer.start()
-            loop.exec_()
-            raise e
-    # 2. For high-precision, manually process events 1-by-1 during the last ms
-    while default_timer() < end_time:
-        APP.processEvents()
+    if new_delay > 0:
+        _run_loop(new_delay)
+    # 2. For high-precision, manually process events during the last ms
+    if mode == 'precise':
+        while True:
+            process_events()
+            remaining = end_time - default_timer()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, SLEEP_SLICE))
+    elif mode == 'spin':
+        while default_timer() < end_time:
+            process_events()
+    else:  # coarse: Qt timers may return slightly early
+        while default_timer() < end_time:
+            process_events()
+            time.sleep(max(0, min(end_time - default_timer(), 1e-3)))
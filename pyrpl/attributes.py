@@ -1474,10 +1474,11 @@ class CurveSelectProperty(SelectProperty):
         SelectProperty.__init__(self, options=self._default_options, **kwargs)
 
     def _default_options(self):
+        # all_pks does not need to load the curves
         if self.no_curve_first:
-            return [-1] + [curve.pk for curve in CurveDB.all()]
+            return [-1] + CurveDB.all_pks()
         else:
-            return [curve.pk for curve in CurveDB.all()] + [-1]
+            return CurveDB.all_pks() + [-1]
         #return OrderedDict([(k, k) for k in (CurveDB.all()) + [-1]])
 
     def validate_and_normalize(self, obj, value):
@@ -0,0 +1,335 @@
+"""
+Benchmarks of the acquisition throughput of pyrpl.
+
+The benchmarks report the rate (per second) and the latency percentiles
+(in ms) of the most common operations:
+
+- register reads and writes,
+- Module.setup() of a few hardware modules,
+- Scope.curve() and frame updates in Scope rolling mode,
+- SpectrumAnalyzer.single(),
+- NetworkAnalyzer.single() (in points per second),
+- async_utils.sleep() in the available sleep modes (precision vs. CPU
+  load).
+
+The results are collected into a json-compatible dict, such that they can
+be stored and compared between pyrpl versions. The benchmarks can run
+against a real Red Pitaya, against the DummyClient
+(hostname='_FAKE_REDPITAYA_'), or against the DummyClient served on a
+localhost socket by EmulatorServer (hostname='_EMULATOR_'). The latter
+includes the overhead of the MonitorClient transport.
+
+Usage from the command line::
+
+    python -m pyrpl.benchmark [hostname] [--repetitions N] [--output file.json]
+
+or from python::
+
+    from pyrpl.benchmark import run_benchmarks
+    results = run_benchmarks(hostname='_EMULATOR_', repetitions=20)
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import logging
+import platform
+import socket
+import sys
+import threading
+import time
+from timeit import default_timer
+
+import numpy as np
+
+from ._version import __version__
+from .redpitaya_client import MonitorClient, DummyClient
+
+logger = logging.getLogger(name=__name__)
+
+
+class EmulatorServer(threading.Thread):
+    """
+    Serves the memory of a DummyClient on a localhost socket with the
+    protocol of monitor_server, such that a MonitorClient can connect to it
+    (e.g. MonitorClient('localhost', server.port)).
+    """
+    def __init__(self, client=None, port=0):
+        super(EmulatorServer, self).__init__(name="pyrpl emulator server")
+        self.daemon = True
+        self.client = client if client is not None else DummyClient()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('localhost', port))
+        self._socket.listen(5)
+        self.port = self._socket.getsockname()[1]
+        self._stopped = False
+
+    def run(self):
+        while not self._stopped:
+            try:
+                connection, address = self._socket.accept()
+            except socket.error:
+                return  # socket was closed by stop()
+            handler = threading.Thread(target=self._serve,
+                                       args=(connection,))
+            handler.daemon = True
+            handler.start()
+
+    def stop(self):
+        self._stopped = True
+        self._socket.close()
+
+    @staticmethod
+    def _recv(connection, n):
+        data = b''
+        while len(data) < n:
+            chunk = connection.recv(n - len(data))
+            if not chunk:
+                raise socket.error("connection closed")
+            data += chunk
+        return data
+
+    def _serve(self, connection):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                header = self._recv(connection, 8)
+                command = header[:1]
+                length = header[2] + (header[3] << 8) \
+                    if sys.version_info[0] > 2 \
+                    else ord(header[2]) + (ord(header[3]) << 8)
+                addr = int(np.frombuffer(header[4:], dtype='<u4')[0])
+                if command == b'r':
+                    data = self.client.reads(addr, length)
+                    connection.sendall(
+                        header + np.asarray(data, dtype='<u4').tobytes())
+                elif command == b'w':
+                    values = np.frombuffer(
+                        self._recv(connection, 4 * length), dtype='<u4')
+                    self.client.writes(addr, [int(v) for v in values])
+                    connection.sendall(header)
+                else:  # b'c': close
+                    return
+        except socket.error:
+            return
+        finally:
+            connection.close()
+
+
+def _statistics(durations, items=1):
+    """
+    Summarizes a list of durations (in seconds) of operations that each
+    process 'items' items (e.g. points of a network analyzer scan).
+    """
+    durations = np.asarray(durations, dtype=float)
+    ms = durations * 1e3
+    return dict(n=len(durations),
+                rate=float(items * len(durations) / durations.sum()),
+                latency_mean_ms=float(ms.mean()),
+                latency_p50_ms=float(np.percentile(ms, 50)),
+                latency_p90_ms=float(np.percentile(ms, 90)),
+                latency_p99_ms=float(np.percentile(ms, 99)),
+                latency_max_ms=float(ms.max()))
+
+
+def _time_calls(func, repetitions):
+    """ returns the list of durations of repetitions calls of func() """
+    durations = []
+    for i in range(repetitions):
+        tic = default_timer()
+        func()
+        durations.append(default_timer() - tic)
+    return durations
+
+
+def benchmark_registers(redpitaya, repetitions=1000):
+    """ single register reads and writes """
+    hk = redpitaya.hk
+
+    def write():
+        hk.led = 0
+
+    return dict(read=_statistics(_time_calls(lambda: hk.led, repetitions)),
+                write=_statistics(_time_calls(write, repetitions)))
+
+
+def benchmark_setup(redpitaya, repetitions=20,
+                    modules=('scope', 'asg0', 'pid0', 'iq0')):
+    """ Module.setup() of a few hardware modules """
+    return dict((name, _statistics(_time_calls(
+                    getattr(redpitaya, name).setup, repetitions)))
+                for name in modules)
+
+
+def benchmark_scope(redpitaya, repetitions=20):
+    """ Scope.curve() of the shortest curves """
+    scope = redpitaya.scope
+    scope.setup(duration=scope.durations[0], trigger_source='immediately',
+                trace_average=1, running_state='stopped')
+    return _statistics(_time_calls(lambda: scope.curve(timeout=5.),
+                                   repetitions))
+
+
+def benchmark_scope_rolling(redpitaya, repetitions=20):
+    """ update of the frame in rolling mode (without display) """
+    scope = redpitaya.scope
+    scope.setup(duration=1., rolling_mode=True, trigger_source='immediately',
+                running_state='stopped')
+    scope._start_acquisition_rolling_mode()
+    try:
+        return _statistics(_time_calls(scope._get_rolling_curve,
+                                       repetitions))
+    finally:
+        scope.stop()
+
+
+def benchmark_spectrum_analyzer(pyrpl, repetitions=10):
+    """ SpectrumAnalyzer.single() without averaging """
+    sa = pyrpl.spectrumanalyzer
+    sa.setup(span=1e5, trace_average=1, running_state='stopped')
+    try:
+        return _statistics(_time_calls(lambda: sa.single(timeout=10.),
+                                       repetitions))
+    finally:
+        sa.stop()
+
+
+def benchmark_network_analyzer(pyrpl, repetitions=3, points=5):
+    """ NetworkAnalyzer.single(), the rate is in points per second """
+    na = pyrpl.networkanalyzer
+    na.setup(start_freq=1e5, stop_freq=2e5, points=points, rbw=1e5,
+             avg_per_point=1, trace_average=1, running_state='stopped')
+    # the rbw is rounded to the available bandwidths (only ~1 Hz with the
+    # DummyClient), and the first point takes 3 times longer
+    timeout = 10. + 2. * (points + 2) * (na.sleeptimes + na.avg_per_point) \
+        / na.rbw
+    try:
+        return _statistics(_time_calls(lambda: na.single(timeout=timeout),
+                                       repetitions), items=points)
+    finally:
+        na.stop()
+
+
+def benchmark_sleep(repetitions=20, delays=(1e-3, 1e-2)):
+    """
+    precision (delay error in ms) and CPU load (process time / wall time)
+    of async_utils.sleep() in each sleep mode
+    """
+    from .async_utils import sleep, SLEEP_MODES
+    try:
+        process_time = time.process_time
+    except AttributeError:  # python 2.7
+        process_time = time.clock
+    results = dict()
+    for mode in SLEEP_MODES:
+        results[mode] = dict()
+        for delay in delays:
+            errors = []
+            cpu, wall = process_time(), default_timer()
+            for i in range(repetitions):
+                tic = default_timer()
+                sleep(delay, mode=mode)
+                errors.append(default_timer() - tic - delay)
+            cpu, wall = process_time() - cpu, default_timer() - wall
+            errors = np.asarray(errors) * 1e3
+            results[mode]["%g ms" % (delay * 1e3)] = dict(
+                error_mean_ms=float(errors.mean()),
+                error_p99_ms=float(np.percentile(errors, 99)),
+                error_min_ms=float(errors.min()),
+                cpu_load=float(cpu / wall))
+    return results
+
+
+def _use_emulator(redpitaya):
+    """
+    serves the memory of the DummyClient of redpitaya on localhost and
+    connects all modules to it through a MonitorClient
+    """
+    server = EmulatorServer(redpitaya.client)
+    server.start()
+    client = MonitorClient('localhost', server.port)
+    redpitaya.client = client
+    for module in redpitaya.modules.values():
+        module._client = client
+    return server
+
+
+def run_benchmarks(hostname='_FAKE_REDPITAYA_', repetitions=20,
+                   config='benchmark', pyrpl=None):
+    """
+    Runs all benchmarks and returns the results in a json-compatible dict.
+
+    :param hostname: hostname of the Red Pitaya, '_FAKE_REDPITAYA_' for
+    the DummyClient or '_EMULATOR_' for the DummyClient on a localhost
+    socket.
+    :param repetitions: number of repetitions of each operation (the
+    register benchmarks use 50 times more repetitions).
+    :param config: config file of the Pyrpl instance
+    :param pyrpl: existing Pyrpl instance to use instead of creating one
+    """
+    from .pyrpl import Pyrpl
+    server = None
+    if pyrpl is None:
+        pyrpl = Pyrpl(config=config, gui=False,
+                      hostname='_FAKE_REDPITAYA_' if hostname == '_EMULATOR_'
+                      else hostname)
+        if hostname == '_EMULATOR_':
+            server = _use_emulator(pyrpl.rp)
+    benchmarks = [
+        ('registers', benchmark_registers, pyrpl.rp, 50 * repetitions),
+        ('setup', benchmark_setup, pyrpl.rp, repetitions),
+        ('scope', benchmark_scope, pyrpl.rp, repetitions),
+        ('scope_rolling', benchmark_scope_rolling, pyrpl.rp, repetitions),
+        ('spectrum_analyzer', benchmark_spectrum_analyzer, pyrpl,
+         max(1, repetitions // 2)),
+        ('network_analyzer', benchmark_network_analyzer, pyrpl,
+         max(1, repetitions // 10))]
+    results = dict(pyrpl_version=__version__,
+                   python_version=platform.python_version(),
+                   platform=platform.platform(),
+                   hostname=hostname,
+                   date=datetime.datetime.now().isoformat(),
+                   repetitions=repetitions,
+                   results=dict())
+    try:
+        for name, benchmark, obj, n in benchmarks:
+            logger.info("Running benchmark %s...", name)
+            try:
+                results['results'][name] = benchmark(obj, n)
+            except Exception as e:  # report failures and go on
+                logger.error("Benchmark %s failed: %s", name, e)
+                results['results'][name] = dict(error=repr(e))
+        results['results']['sleep'] = benchmark_sleep(repetitions)
+    finally:
+        if server is not None:
+            server.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the acquisition throughput of pyrpl.")
+    parser.add_argument('hostname', nargs='?', default='_FAKE_REDPITAYA_',
+                        help="hostname of the Red Pitaya, _FAKE_REDPITAYA_ "
+                             "(default) or _EMULATOR_")
+    parser.add_argument('--repetitions', type=int, default=20)
+    parser.add_argument('--config', default='benchmark')
+    parser.add_argument('--output', default=None,
+                        help="json file to write the results to (default: "
+                             "print to stdout)")
+    args = parser.parse_args(argv)
+    results = run_benchmarks(hostname=args.hostname,
+                             repetitions=args.repetitions,
+                             config=args.config)
+    if args.output is None:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -30,236 +30,1372 @@
 import numpy as np
 import pandas as pd
 import os
+import atexit
+import copy
+import fnmatch
+import json
 import logging
+import sqlite3
+import threading
+import time
 import pickle as file_backend
+from collections import OrderedDict
+from concurrent.futures import Future
 #import json as file_backend  # currently unable to store pandas
+from . import user_curve_dir
 
+logger = logging.getLogger(name=__name__)
 
-# optional override of CurveDB class with custom module, as defined in
-# ./pyrpl/config/global_config.yml
-try:
-    from . import global_config
-    CurveDB = __import__(global_config.general.curvedb).CurveDB
-except:
-    from . import user_curve_dir
-    class CurveDB(object):
-        _dirname = user_curve_dir
-        file_extension = '.dat'
-
-        if not os.path.exists(_dirname): # if _dirname doesn't exist, some unexpected errors will occur.
-            os.mkdir(_dirname)
-
-        def __init__(self, name="some_curve"):
-            """
-            A CurveDB object has
-            - name   = string to give the curve a name
-            - pk     = integer to uniquely identify the curve (the database primary key)
-            - data   = pandas.Series() object to hold any data
-            - params = dict() with all kinds of parameters
-            """
-            self.logger = logging.getLogger(name=__name__)
-            self.params = dict()
-            x, y = np.array([], dtype=np.float), np.array([], dtype=np.float)
-            self.data = (x, y)
-            self.name = name
-
-        @property
-        def name(self):
-            return self.params["name"]
-
-        @name.setter
-        def name(self, val):
-            self.params["name"] = val
-            return val
-
-        @classmethod
-        def create(cls, *args, **kwds):
-            """
-            Creates a new curve, first arguments should be either
-            Series(y, index=x) or x, y.
-            kwds will be passed to self.params
-            """
-            if len(args) == 0:
-                ser = (np.array([], dtype=np.float), np.array([], dtype=np.float))
-            if len(args) == 1:
-                if isinstance(args[0], pd.Series):
-                    x, y = args[0].index.values, args[0].values
-                    ser = (x, y)
-                elif isinstance(args[0], (np.array, list, tuple)):
-                    ser = args[0]
+
+def save_array(filename, array):
+    """
+    Writes array in .npy format to filename. The file is written under a
+    temporary name and then renamed, such that existing memory maps of
+    the previous file content remain valid.
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, np.asarray(array))
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)  # rename does not overwrite on windows
+    os.rename(tmp_filename, filename)
+
+
+def load_array(filename, mmap_mode=None):
+    """ Reads an array written by save_array, memory-mapped if possible """
+    if mmap_mode is not None:
+        try:
+            return np.load(filename, mmap_mode=mmap_mode)
+        except ValueError:  # e.g. empty arrays cannot be memory-mapped
+            pass
+    return np.load(filename)
+
+
+def minmax_decimate(x, y, factor):
+    """
+    Returns the arrays (x, y) that contain the minimum and the maximum of
+    y in each bin of factor points, i.e. two points per bin at the x-value
+    of the first point of the bin.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    starts = np.arange(0, len(y), factor)
+    if len(starts) == 0:
+        return x, y
+    ys = np.empty(2 * len(starts), dtype=y.dtype)
+    ys[0::2] = np.minimum.reduceat(y, starts)
+    ys[1::2] = np.maximum.reduceat(y, starts)
+    return np.repeat(x[starts], 2), ys
+
+
+def decimate(x, y, max_points):
+    """
+    Returns the data (x, y) reduced to at most about max_points points. Real
+    data are reduced with minmax_decimate such that no peak is lost, complex
+    data are simply subsampled.
+    """
+    if len(y) <= max_points:
+        return np.asarray(x), np.asarray(y)
+    if np.iscomplexobj(y):
+        step = -(-len(y) // max_points)
+        return np.asarray(x[::step]), np.asarray(y[::step])
+    return minmax_decimate(x, y, -(-2 * len(y) // max_points))
+
+
+class FileLock(object):
+    """
+    A lock between processes (and threads) based on the atomic creation of
+    the file filename. A lock file older than stale_timeout seconds is
+    assumed to be left over by a crashed process and is broken by renaming
+    it to a unique name, such that only one of several waiting processes
+    can break it and all of them retry to create the lock file.
+
+    Usage::
+
+        with FileLock(filename):
+            do_something_exclusively()
+    """
+    def __init__(self, filename, stale_timeout=10.0):
+        self.filename = filename
+        self.stale_timeout = stale_timeout
+
+    def __enter__(self):
+        while True:
+            try:
+                fd = os.open(self.filename,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                try:
+                    age = time.time() - os.path.getmtime(self.filename)
+                except OSError:  # lock was just released
+                    continue
+                if age > self.stale_timeout:
+                    self._break_stale_lock()
                 else:
-                    raise ValueError("cannot recognize argument %s as numpy.array or pandas.Series.", args[0])
-            elif len(args) == 2:
-                x = np.array(args[0])
-                y = np.array(args[1])
-                ser = (x, y)
-            else:
-                raise ValueError("first arguments should be either x or x, y")
-            obj = cls()
-            obj.data = ser
-            obj.params = kwds
-            if not 'name' in obj.params:
-                obj.params['name'] = 'new_curve'
-            pk = obj.pk  # make a pk
-            if "childs" not in obj.params:
-                obj.params["childs"] = None
-            if ("autosave" not in kwds) or (kwds["autosave"]):
-                obj.save()
-            return obj
-
-        def plot(self):
-            self.data.plot()
-
-        # Implement the following methods if you want to save curves permanently
-        @classmethod
-        def get(cls, curve):
-            if isinstance(curve, CurveDB):
-                return curve
-            elif isinstance(curve, list):
-                return [CurveDB.get(c) for c in curve]
+                    time.sleep(0.001)
             else:
-                with open(os.path.join(CurveDB._dirname, str(curve) + cls.file_extension),
-                          'rb' if file_backend.__name__ == 'pickle' else 'r')\
-                        as f:
-                    # rb is for compatibility with python 3
-                    # see http://stackoverflow.com/questions/5512811/builtins-typeerror-must-be-str-not-bytes
-                    curve = CurveDB()
-                    curve._pk, curve.params, data = file_backend.load(f)
-                    curve.data = tuple([np.asarray(a) for a in data])
-                if isinstance(curve.data, pd.Series):  # for backwards compatibility
-                    x, y = curve.data.index.values, curve.data.values
-                    curve.data = (x, y)
-                return curve
-
-        def save(self):
-            with open(os.path.join(self._dirname, str(self.pk) + self.file_extension),
-                      'wb' if file_backend.__name__ == 'pickle' else 'w')\
-                    as f:
-                # wb is for compatibility with python 3
-                # see http://stackoverflow.com/questions/5512811/builtins-typeerror-must-be-str-not-bytes
-                data = [a.tolist() for a in self.data]
-                file_backend.dump([self.pk, self.params, data], f, )
-
-        def delete(self):
-            # remove the file
-            delpk = self.pk
-            parent = self.parent
-            childs = self.childs
-            if isinstance(childs, list) and len(childs)> 0:
-                self.logger.debug("Deleting all childs of curve %d"%delpk)
-                for child in childs:
-                    child.delete()
-            self.logger.debug("Deleting curve %d" % delpk)
+                os.close(fd)
+                return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        os.remove(self.filename)
+
+    def _break_stale_lock(self):
+        broken = "%s.%d.%d.stale" % (self.filename, os.getpid(),
+                                     threading.current_thread().ident)
+        try:
+            os.rename(self.filename, broken)
+        except OSError:  # broken or released by somebody else
+            return
+        if time.time() - os.path.getmtime(broken) <= self.stale_timeout:
+            # the lock was re-created after the age check: put it back
             try:
-                filename = os.path.join(self._dirname, str(self.pk) + self.file_extension)
-                os.remove(filename)
+                os.link(broken, self.filename)
             except OSError:
-                self.logger.warning("Could not find and remove the file %s. ",
-                                    filename)
-            if parent:
-                parentchilds = parent.childs
-                parentchilds.remove(delpk)
-                parent.childs = parentchilds
-                parent.save()
+                logger.error("Could not restore lock file %s.",
+                             self.filename)
+        else:
+            logger.warning("Removed stale lock file %s.", self.filename)
+        os.remove(broken)
+
+
+class PayloadCache(object):
+    """
+    A least-recently-used cache for the data arrays of loaded curves.
 
-        # Implement the following methods if you want to use a hierarchical
-        # structure for curves
-        @property
-        def childs(self):
+    The cache holds at most max_items curves with a total size of max_bytes.
+    Only data read from disc (i.e. read-only arrays) are cached, and the
+    entry of a curve is removed whenever the curve is saved with new data or
+    deleted. Changes of the data files by other processes are not detected.
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20, max_items=100):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self._items = OrderedDict()  # {key: (data, nbytes)}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ returns the cached data for key or None """
+        with self._lock:
             try:
-                childs = self.params["childs"]
+                data, nbytes = self._items.pop(key)
             except KeyError:
-                return []
-            if childs is None:
-                return []
+                return None
+            self._items[key] = (data, nbytes)  # most recently used is last
+            return data
+
+    def put(self, key, data):
+        nbytes = sum(np.asarray(a).nbytes for a in data)
+        with self._lock:
+            self._pop(key)
+            if nbytes > self.max_bytes:
+                return
+            self._items[key] = (data, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes or \
+                    len(self._items) > self.max_items:
+                self._pop(next(iter(self._items)))
+
+    def pop(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        try:
+            data, nbytes = self._items.pop(key)
+        except KeyError:
+            pass
+        else:
+            self._nbytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+
+payload_cache = PayloadCache()
+
+
+class CurveSaver(threading.Thread):
+    """
+    A thread that saves curves in the background.
+
+    Curves are submitted as snapshots of their params and data. Only the
+    most recent snapshot of each curve is kept in the queue, such that
+    several saves of the same curve (e.g. upon add_child) that occur before
+    the thread gets to work result in a single write operation. The
+    futures of all coalesced saves are completed by this write. The data
+    of the submitted curves are only marked as saved once the write has
+    succeeded.
+
+    Points submitted with submit_append() are appended to the curve itself
+    (not to a snapshot) in the order of submission.
+    """
+    def __init__(self):
+        super(CurveSaver, self).__init__(name="pyrpl_curve_saver")
+        self.daemon = True
+        self._condition = threading.Condition()
+        # {key: (snapshot, [futures], [(curve, data) saved by snapshot])}
+        # and {key + ('append',): (curve, [futures], [(x, y, flush)])}
+        self._pending = OrderedDict()
+        self._busy = None  # the key of the curve that is being written
+
+    @staticmethod
+    def _key(curve):
+        return (curve._dirname, curve.pk)
+
+    def submit(self, curve):
+        """ schedules saving a snapshot of curve and returns a Future """
+        snapshot = copy.copy(curve)
+        snapshot.params = copy.deepcopy(curve.params)
+        snapshot._append_buffer = []  # written by the curve itself
+        updates = []
+        if not curve._data_saved:
+            # the caller may modify the data arrays in-place after submission
+            snapshot._data = tuple(np.array(a) for a in curve.data)
+            updates.append((curve, curve._data))
+        future = Future()
+        key = self._key(curve)
+        with self._condition:
+            if key in self._pending:
+                previous, futures, previous_updates = self._pending.pop(key)
+                updates = previous_updates + updates
+                if not previous._data_saved and snapshot._data_saved:
+                    # the data of the previous snapshot remain to be written
+                    snapshot._data = previous._data
+                    snapshot._data_saved = False
             else:
+                futures = []
+            self._pending[key] = (snapshot, futures + [future], updates)
+            self._condition.notify_all()
+        return future
+
+    def submit_append(self, curve, x, y, flush=False):
+        """ schedules curve.append(x, y), followed by curve.flush() if flush
+        is True, and returns a Future """
+        future = Future()
+        key = self._key(curve) + ('append',)
+        with self._condition:
+            _, futures, appends = self._pending.pop(key, (curve, [], []))
+            appends.append((np.array(x), np.array(y), flush))  # copies
+            self._pending[key] = (curve, futures + [future], appends)
+            self._condition.notify_all()
+        return future
+
+    def _busy_with(self, key):
+        """ True if a save or append of the curve with key (or of any curve
+        if key is None) is pending or ongoing. Requires _condition. """
+        if key is None:
+            return len(self._pending) > 0 or self._busy is not None
+        keys = [key, key + ('append',)]
+        return any(k in self._pending for k in keys) or self._busy in keys
+
+    def pending(self, curve):
+        """ returns True if a save of curve is pending or ongoing """
+        with self._condition:
+            return self._busy_with(self._key(curve))
+
+    def wait(self, key=None):
+        """ blocks until no save of the curve with key (or of any curve if
+        key is None) is pending or ongoing """
+        with self._condition:
+            while self._busy_with(key):
+                self._condition.wait()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+                key, (snapshot, futures, updates) = \
+                    self._pending.popitem(last=False)
+                self._busy = key
+            try:
+                if key[-1] == 'append':
+                    for x, y, flush in updates:
+                        snapshot.append(x, y)
+                        if flush:
+                            snapshot.flush()
+                    updates = []
+                else:
+                    snapshot.save()
+            except BaseException as e:
+                logger.error("Error in background saving of curve %s: %s",
+                             snapshot.pk, e)
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for curve, data in updates:
+                    if curve._data is data:  # not re-assigned in the meantime
+                        curve._data_saved = True
+                for future in futures:
+                    future.set_result(snapshot.pk)
+            finally:
+                with self._condition:
+                    self._busy = None
+                    self._condition.notify_all()
+
+
+# the saver thread is only started once it is needed
+_curve_saver = None
+_curve_saver_lock = threading.Lock()
+
+
+def get_curve_saver():
+    """ returns the (unique) CurveSaver thread """
+    global _curve_saver
+    with _curve_saver_lock:
+        if _curve_saver is None:
+            _curve_saver = CurveSaver()
+            _curve_saver.start()
+        return _curve_saver
+
+
+# curves with points buffered by append() that are not yet written (kept
+# alive until they are written)
+_appending_curves = set()
+
+
+@atexit.register
+def flush_curves():
+    """ writes the points buffered by append() and blocks until all curves
+    submitted for background saving are written """
+    if _curve_saver is not None:
+        _curve_saver.wait()  # the saver may append points, too
+    for curve in list(_appending_curves):
+        curve.flush()
+    if _curve_saver is not None:
+        _curve_saver.wait()
+
+
+class CurveDB(object):
+    """
+    Curves are stored in the directory _dirname in the following files:
+
+    - <pk>.params: the pickled list [pk, params]
+    - <pk>.x.npy and <pk>.y.npy: the data arrays in numpy's binary format
+
+    Curves in the legacy format <pk>.dat (pickled [pk, params, data] with
+    data as lists) can still be read and are converted to the current
+    format with CurveDB.migrate() or upon the next save().
+
+    create_async() and save_async() save curves in a background thread
+    and return immediately, such that acquisitions are not slowed down by
+    disc access.
+
+    Long recordings can be written piecewise with curve.append(x, y). The
+    points are buffered and written together (see append()) into the chunk
+    files <pk>.chunk<i>.x.npy and <pk>.chunk<i>.y.npy of up to
+    append_chunk_size points, and curve.data_range(x0, x1) only loads the
+    chunks that overlap with the requested x-range.
+
+    Curves with more than pyramid_threshold real-valued points sorted by x
+    are saved together with min/max-decimated versions of the data in the
+    files <pk>.level<k>.x.npy and <pk>.level<k>.y.npy, where level k
+    reduces bins of pyramid_factor**k points to their minimum and maximum.
+    Chunks of more than pyramid_threshold points of curves written with
+    append() get their own levels <pk>.chunk<i>.level<k>.x.npy and
+    <pk>.chunk<i>.level<k>.y.npy.
+    curve.get_range(x0, x1, max_points) picks the appropriate level, such
+    that long curves can be displayed at any zoom without loading them.
+
+    Curves returned by get() only load their params. The data arrays are
+    loaded upon the first access of curve.data, and recently used data are
+    kept in the PayloadCache payload_cache.
+    """
+    _dirname = user_curve_dir
+    file_extension = '.dat'  # legacy format
+    params_extension = '.params'
+    # the data arrays are memory-mapped, i.e. they are only read from disc
+    # when accessed. Windows cannot delete memory-mapped files, so data are
+    # simply read there. In both cases, loaded data arrays are read-only:
+    # to modify the data of a curve, assign a new tuple to curve.data.
+    mmap_mode = None if os.name == 'nt' else 'r'
+    # decimation levels are stored for longer curves (None: never)
+    pyramid_threshold = 100000
+    pyramid_factor = 8
+    # points passed to append() are written at the latest after
+    # append_interval seconds, into chunks of up to append_chunk_size points
+    append_chunk_size = 200000
+    append_interval = 10.
+
+    if not os.path.exists(_dirname): # if _dirname doesn't exist, some unexpected errors will occur.
+        os.mkdir(_dirname)
+
+    def __init__(self, name="some_curve"):
+        """
+        A CurveDB object has
+        - name   = string to give the curve a name
+        - pk     = integer to uniquely identify the curve (the database primary key)
+        - data   = pandas.Series() object to hold any data
+        - params = dict() with all kinds of parameters
+        """
+        self.logger = logging.getLogger(name=__name__)
+        self.params = dict()
+        self.saved = None  # Future of the last background save
+        self._append_buffer = []  # [(x, y)] not yet written by flush()
+        x, y = np.array([], dtype=np.float), np.array([], dtype=np.float)
+        self.data = (x, y)
+        self.name = name
+
+    @property
+    def data(self):
+        """ tuple (x, y) of data arrays, loaded upon first access """
+        if self._append_buffer:
+            self.flush()
+        if self._data is None:
+            key = (self._dirname, self.pk)
+            self._data = payload_cache.get(key)
+            if self._data is None:
                 try:
-                    return CurveDB.get(childs)
-                except KeyError:
-                    return []
+                    self._data = self._load_data()
+                except IOError:
+                    self.logger.warning("Data of curve %s not found.",
+                                        self.pk)
+                    self._data = (np.array([]), np.array([]))
+                else:
+                    payload_cache.put(key, self._data)
+        return self._data
+
+    @data.setter
+    def data(self, val):
+        self._data = val
+        self._data_saved = False  # data arrays must be written upon save
+        self._append_buffer = []  # the new data replace appended points
+
+    @property
+    def name(self):
+        return self.params["name"]
+
+    @name.setter
+    def name(self, val):
+        self.params["name"] = val
+        return val
+
+    @classmethod
+    def create(cls, *args, **kwds):
+        """
+        Creates a new curve, first arguments should be either
+        Series(y, index=x) or x, y.
+        kwds will be passed to self.params
+        """
+        if len(args) == 0:
+            ser = (np.array([], dtype=np.float), np.array([], dtype=np.float))
+        elif len(args) == 1:
+            if isinstance(args[0], pd.Series):
+                x, y = args[0].index.values, args[0].values
+                ser = (x, y)
+            elif isinstance(args[0], (np.ndarray, list, tuple)):
+                ser = args[0]
+            else:
+                raise ValueError("cannot recognize argument %s as numpy.array or pandas.Series.", args[0])
+        elif len(args) == 2:
+            x = np.array(args[0])
+            y = np.array(args[1])
+            ser = (x, y)
+        else:
+            raise ValueError("first arguments should be either x or x, y")
+        obj = cls()
+        obj.data = ser
+        obj.params = kwds
+        if not 'name' in obj.params:
+            obj.params['name'] = 'new_curve'
+        if not 'created' in obj.params:
+            obj.params['created'] = time.time()  # used by query()
+        pk = obj.pk  # make a pk
+        if "childs" not in obj.params:
+            obj.params["childs"] = None
+        if ("autosave" not in kwds) or (kwds["autosave"]):
+            obj.save()
+        return obj
+
+    @classmethod
+    def create_async(cls, *args, **kwds):
+        """
+        Same as create(), but the curve is saved in a background thread.
+        The pk of the returned curve is valid immediately, and the Future
+        curve.saved completes (with the pk as result) once the curve is
+        written.
+        """
+        obj = cls.create(*args, **dict(kwds, autosave=False))
+        if "autosave" in kwds:
+            obj.params["autosave"] = kwds["autosave"]
+        else:
+            obj.params.pop("autosave")
+        if kwds.get("autosave", True):
+            obj.save_async()
+        return obj
+
+    def plot(self):
+        self.data.plot()
+
+    # Implement the following methods if you want to save curves permanently
+    @classmethod
+    def get(cls, curve):
+        if isinstance(curve, cls):
+            return curve
+        elif isinstance(curve, list):
+            return [cls.get(c) for c in curve]
+        else:
+            cls._wait_saved(curve)
+            filename = os.path.join(cls._dirname,
+                                    str(curve) + cls.params_extension)
+            if not os.path.exists(filename):
+                return cls._get_legacy(curve)
+            curve = cls()
+            with open(filename, 'rb') as f:
+                curve._pk, curve.params = file_backend.load(f)
+            curve._data, curve._data_saved = None, True  # loaded if needed
+            return curve
+
+    @classmethod
+    def _get_legacy(cls, curve):
+        """ loads a curve stored in the legacy .dat format """
+        with open(os.path.join(cls._dirname, str(curve) + cls.file_extension),
+                  'rb' if file_backend.__name__ == 'pickle' else 'r')\
+                as f:
+            # rb is for compatibility with python 3
+            # see http://stackoverflow.com/questions/5512811/builtins-typeerror-must-be-str-not-bytes
+            curve = cls()
+            curve._pk, curve.params, data = file_backend.load(f)
+            curve.data = tuple([np.asarray(a) for a in data])
+        if isinstance(curve.data, pd.Series):  # for backwards compatibility
+            x, y = curve.data.index.values, curve.data.values
+            curve.data = (x, y)
+        return curve
+
+    def _data_filenames(self):
+        """ returns the filenames of the x and y data arrays """
+        base = os.path.join(self._dirname, str(self.pk))
+        return base + '.x.npy', base + '.y.npy'
+
+    def _chunk_filenames(self, index):
+        """ returns the filenames of the x and y arrays of chunk index """
+        base = os.path.join(self._dirname, '%s.chunk%d' % (self.pk, index))
+        return base + '.x.npy', base + '.y.npy'
 
-        @property
-        def parent(self):
+    def _chunk_level_filenames(self, index, level):
+        """ returns the filenames of the x and y arrays of a pyramid level
+        of chunk index """
+        base = os.path.join(self._dirname,
+                            '%s.chunk%d.level%d' % (self.pk, index, level))
+        return base + '.x.npy', base + '.y.npy'
+
+    def _chunk_levels(self, index):
+        """ returns the number of stored pyramid levels of chunk index """
+        chunk = self.chunks[index]
+        return chunk[3] if len(chunk) > 3 else 0  # older curves: no levels
+
+    def _all_chunk_filenames(self):
+        filenames = []
+        for index in range(len(self.chunks or [])):
+            filenames += self._chunk_filenames(index)
+            for level in range(1, self._chunk_levels(index) + 1):
+                filenames += self._chunk_level_filenames(index, level)
+        return filenames
+
+    def _overlapping_chunks(self, x0, x1):
+        """ returns the indices of the chunks that overlap with [x0, x1] """
+        return [index for index, chunk in enumerate(self.chunks)
+                if (x0 is None or chunk[2] >= x0) and
+                (x1 is None or chunk[1] <= x1)]
+
+    def _load_data(self):
+        if self.chunks is not None:
+            return self._load_chunks(range(len(self.chunks)))
+        data = tuple(load_array(filename, mmap_mode=self.mmap_mode)
+                     for filename in self._data_filenames())
+        for a in data:
+            a.setflags(write=False)  # save() only writes assigned data
+        return data
+
+    def _load_chunks(self, indices):
+        """ returns the concatenated data of the chunks indices """
+        xs, ys = [np.array([])], [np.array([])]
+        for index in indices:
+            x, y = [load_array(filename, mmap_mode=self.mmap_mode)
+                    for filename in self._chunk_filenames(index)]
+            xs.append(x)
+            ys.append(y)
+        data = (np.concatenate(xs), np.concatenate(ys))
+        for a in data:
+            a.setflags(write=False)
+        return data
+
+    @property
+    def chunks(self):
+        """
+        list of [number of points, min(x), max(x), number of pyramid
+        levels] for each chunk of a curve that was written with append(),
+        None for other curves
+        """
+        return self.params.get("chunks")
+
+    def append(self, x, y):
+        """
+        Appends the points (x, y) to the curve.
+
+        The points are buffered in memory and written by flush(), which is
+        called once append_chunk_size points are buffered or append_interval
+        seconds after the first buffered point, as well as before the data
+        of the curve are read and at exit (see flush_curves()). The
+        existing data are not rewritten (a curve that already holds data
+        is converted into its first chunk upon the first call).
+
+        Args:
+            x (array): x values of the new points
+            y (array): y values of the new points
+        """
+        x, y = np.atleast_1d(x), np.atleast_1d(y)
+        if len(x) != len(y):
+            raise ValueError("x and y must have the same length.")
+        self._wait_saved(self.pk)  # a pending save would overwrite params
+        if self.chunks is None:
+            previous = self.data
+            self.params["chunks"] = []
+            if len(previous[0]) > 0:
+                self._write_chunk(*previous)
+            for filename in list(self._data_filenames()) + \
+                    self._all_level_filenames():
+                if os.path.exists(filename):
+                    os.remove(filename)
+            payload_cache.pop((self._dirname, self.pk))
+            self._data, self._data_saved = None, True  # reloaded if needed
+            self._save_params()
+        if len(x) == 0:
+            return
+        if not self._append_buffer:
+            self._append_time = time.time()
+            _appending_curves.add(self)
+        self._append_buffer.append((np.array(x), np.array(y)))  # copies
+        if sum(len(x) for x, y in self._append_buffer) >= \
+                self.append_chunk_size or \
+                time.time() - self._append_time >= self.append_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the points buffered by append(). They are added to the last
+        chunk until it holds append_chunk_size points, such that the number
+        of files and the size of the params do not grow with the number of
+        calls of append().
+        """
+        if not self._append_buffer:
+            return
+        x = np.concatenate([x for x, y in self._append_buffer])
+        y = np.concatenate([y for x, y in self._append_buffer])
+        self._append_buffer = []
+        _appending_curves.discard(self)
+        if len(self.chunks) > 0 and \
+                self.chunks[-1][0] < self.append_chunk_size and \
+                self._chunk_levels(len(self.chunks) - 1) == 0:
+            # the last chunk is rewritten together with the new points
+            previous = self._load_chunks([len(self.chunks) - 1])
+            self.chunks.pop()
+            x = np.concatenate([previous[0], x])
+            y = np.concatenate([previous[1], y])
+        self._write_chunk(x, y)
+        payload_cache.pop((self._dirname, self.pk))
+        self._data, self._data_saved = None, True  # reloaded if needed
+        self._save_params()
+
+    def _write_chunk(self, x, y):
+        index = len(self.chunks)
+        for filename, a in zip(self._chunk_filenames(index), (x, y)):
+            save_array(filename, a)
+        levels = 0  # same rule as for the whole curve in _save_pyramid
+        if self.pyramid_threshold is not None and \
+                len(x) > self.pyramid_threshold:
+            levels = self._write_levels(
+                x, y, lambda level: self._chunk_level_filenames(index, level),
+                self.pyramid_threshold // self.pyramid_factor)
+        self.chunks.append([len(x), float(np.min(x)), float(np.max(x)),
+                            levels])
+
+    def data_range(self, x0=None, x1=None):
+        """
+        Returns the points of the curve with x0 <= x <= x1. For curves
+        written with append(), only the chunks that overlap with the
+        interval are loaded.
+
+        Args:
+            x0 (float): lower bound of x (None for no bound)
+            x1 (float): upper bound of x (None for no bound)
+
+        Returns:
+            tuple: the arrays (x, y)
+        """
+        if self._append_buffer:
+            self.flush()
+        if self.chunks is None or self._data is not None:
+            x, y = self.data
+        else:
+            x, y = self._load_chunks(self._overlapping_chunks(x0, x1))
+        mask = np.ones(len(x), dtype=bool)
+        if x0 is not None:
+            mask &= x >= x0
+        if x1 is not None:
+            mask &= x <= x1
+        return x[mask], y[mask]
+
+    def _level_filenames(self, level):
+        """ returns the filenames of the x and y arrays of a pyramid level """
+        base = os.path.join(self._dirname, '%s.level%d' % (self.pk, level))
+        return base + '.x.npy', base + '.y.npy'
+
+    def _pyramid_levels(self):
+        """ returns the list of stored pyramid levels [1, 2, ...] """
+        levels = []
+        while os.path.exists(self._level_filenames(len(levels) + 1)[1]):
+            levels.append(len(levels) + 1)
+        return levels
+
+    def _all_level_filenames(self):
+        return [filename for level in self._pyramid_levels()
+                for filename in self._level_filenames(level)]
+
+    def _save_pyramid(self):
+        """ writes the decimation levels of the data (if applicable) """
+        for filename in self._all_level_filenames()[::-1]:
+            os.remove(filename)
+        x, y = [np.asarray(a) for a in self.data]
+        if self.pyramid_threshold is not None and \
+                len(y) > self.pyramid_threshold:
+            self._write_levels(x, y, self._level_filenames,
+                               self.pyramid_threshold // self.pyramid_factor)
+
+    def _write_levels(self, x, y, filenames, min_points):
+        """
+        writes the decimation levels of real-valued data sorted by x into
+        the files filenames(level), as long as the data to decimate have
+        more than min_points points. Returns the number of levels.
+        """
+        x, y = np.asarray(x), np.asarray(y)
+        if self.pyramid_threshold is None or y.ndim != 1 or \
+                np.iscomplexobj(y) or np.any(np.diff(x) < 0):
+            return 0
+        level, factor = 1, self.pyramid_factor  # the first level bins data
+        while len(y) > min_points:
+            x, y = minmax_decimate(x, y, factor)
+            for filename, a in zip(filenames(level), (x, y)):
+                save_array(filename, a)
+            # higher levels bin pairs of (min, max) of the previous level
+            level, factor = level + 1, 2 * self.pyramid_factor
+        return level - 1
+
+    def get_range(self, x0=None, x1=None, max_points=10000):
+        """
+        Returns the data with x0 <= x <= x1, reduced to at most about
+        max_points points. For curves with stored decimation levels, only
+        the finest sufficiently decimated level is read.
+
+        Args:
+            x0 (float): lower bound of x (None for no bound)
+            x1 (float): upper bound of x (None for no bound)
+            max_points (int): the maximum number of returned points
+
+        Returns:
+            tuple: the arrays (x, y)
+        """
+        if self._append_buffer:
+            self.flush()
+        if self.chunks is not None and self._data_saved:
+            return self._get_chunks_range(x0, x1, max_points)
+        if not hasattr(self, '_pk') or not self._data_saved or \
+                self.chunks is not None:
+            levels = []
+        else:
+            levels = self._pyramid_levels()
+        if len(levels) == 0:
+            return decimate(*self.data_range(x0, x1), max_points=max_points)
+        x, y = self.data
+        # x is sorted for curves with pyramid, i.e. binary search works
+        start = 0 if x0 is None else np.searchsorted(x, x0, 'left')
+        stop = len(x) if x1 is None else np.searchsorted(x, x1, 'right')
+        level, points = 0, stop - start
+        while level < levels[-1] and points > max_points:
+            level += 1
+            points = 2. * (stop - start) / self.pyramid_factor ** level
+        if level > 0:
+            x, y = [load_array(filename, mmap_mode=self.mmap_mode)
+                    for filename in self._level_filenames(level)]
+            # include the bin that contains x0
+            start = 0 if x0 is None else \
+                max(0, np.searchsorted(x, x0, 'right') - 2)
+            stop = len(x) if x1 is None else np.searchsorted(x, x1, 'right')
+        return decimate(x[start:stop], y[start:stop], max_points)
+
+    def _get_chunks_range(self, x0, x1, max_points):
+        """ get_range() for curves written with append(): the same level is
+        read from all overlapping chunks (or their coarsest level if they
+        have less levels) """
+        indices = self._overlapping_chunks(x0, x1)
+        max_level = max([self._chunk_levels(index) for index in indices] +
+                        [0])
+        # number of points in [x0, x1], assuming evenly spaced x
+        total = 0.
+        for index in indices:
+            n, xmin, xmax = self.chunks[index][:3]
+            if xmax > xmin:
+                n *= (min(xmax, xmax if x1 is None else x1) -
+                      max(xmin, xmin if x0 is None else x0)) / (xmax - xmin)
+            total += n
+        level, points = 0, total
+        while level < max_level and points > max_points:
+            level += 1
+            points = 2. * total / self.pyramid_factor ** level
+        if level == 0:
+            return decimate(*self.data_range(x0, x1), max_points=max_points)
+        xs, ys = [np.array([])], [np.array([])]
+        for index in indices:
+            chunk_level = min(level, self._chunk_levels(index))
+            if chunk_level == 0:  # short chunks or x not sorted
+                mask = np.ones(self.chunks[index][0], dtype=bool)
+                x, y = self._load_chunks([index])
+                if x0 is not None:
+                    mask &= x >= x0
+                if x1 is not None:
+                    mask &= x <= x1
+                xs.append(x[mask])
+                ys.append(y[mask])
+                continue
+            x, y = [load_array(filename, mmap_mode=self.mmap_mode)
+                    for filename in
+                    self._chunk_level_filenames(index, chunk_level)]
+            # include the bin that contains x0
+            start = 0 if x0 is None else \
+                max(0, np.searchsorted(x, x0, 'right') - 2)
+            stop = len(x) if x1 is None else np.searchsorted(x, x1, 'right')
+            xs.append(x[start:stop])
+            ys.append(y[start:stop])
+        return decimate(np.concatenate(xs), np.concatenate(ys), max_points)
+
+    def save(self):
+        if self._append_buffer:
+            self.flush()
+        # data arrays are only written if they have changed
+        if not self._data_saved:
+            payload_cache.pop((self._dirname, self.pk))
+            if self.chunks is not None:
+                # assigned data replace all chunks
+                for filename in self._all_chunk_filenames():
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                self.params.pop("chunks")
+            for filename, a in zip(self._data_filenames(), self.data):
+                save_array(filename, a)
+            self._save_pyramid()
+            self._data_saved = True
+        self._save_params()
+
+    def save_async(self):
+        """
+        Saves the curve in a background thread.
+
+        Returns:
+            Future: completes with the pk of the curve once it is written.
+            The future is also available as curve.saved.
+        """
+        self.saved = get_curve_saver().submit(self)
+        return self.saved
+
+    def append_async(self, x, y, flush=False):
+        """
+        Appends the points (x, y) to the curve (see append()) in a
+        background thread. The curve must not be accessed otherwise until
+        the returned future is done.
+
+        Args:
+            x (array): x values of the new points
+            y (array): y values of the new points
+            flush (bool): if True, the points are written right away
+
+        Returns:
+            Future: completes with the pk of the curve once the points are
+            appended. The future is also available as curve.saved.
+        """
+        self.saved = get_curve_saver().submit_append(self, x, y, flush=flush)
+        return self.saved
+
+    @property
+    def saving(self):
+        """ True while a background save of the curve is pending """
+        return _curve_saver is not None and _curve_saver.pending(self)
+
+    @classmethod
+    def _wait_saved(cls, pk):
+        """ waits for pending background saves of the curve pk """
+        # the saver thread itself must not wait for its own queue
+        if _curve_saver is not None and \
+                threading.current_thread() is not _curve_saver:
+            _curve_saver.wait((cls._dirname, int(pk)))
+
+    def _save_params(self):
+        filename = os.path.join(self._dirname,
+                                str(self.pk) + self.params_extension)
+        with open(filename + '.tmp', 'wb') as f:
+            file_backend.dump([self.pk, self.params], f)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(filename + '.tmp', filename)
+        # the curve is now stored in the current format
+        legacy_filename = os.path.join(self._dirname,
+                                       str(self.pk) + self.file_extension)
+        if os.path.exists(legacy_filename):
+            os.remove(legacy_filename)
+
+    @classmethod
+    def migrate(cls):
+        """
+        Converts all curves in the legacy .dat format to the current format.
+
+        Returns:
+            list of int: the primary keys of the converted curves.
+        """
+        pks = []
+        for filename in sorted(os.listdir(cls._dirname)):
+            if not filename.endswith(cls.file_extension):
+                continue
+            try:
+                pk = int(filename[:-len(cls.file_extension)])
+                curve = cls._get_legacy(pk)
+            except (ValueError, EOFError, IOError,
+                    file_backend.UnpicklingError) as e:
+                logger.warning("Could not convert curve file %s: %s",
+                               filename, e)
+                continue
+            curve.save()
+            pks.append(pk)
+        logger.info("Converted %d curves to the current format.", len(pks))
+        return pks
+
+    def delete(self):
+        # remove the file
+        delpk = self.pk
+        parent = self.parent
+        childs = self.childs
+        if isinstance(childs, list) and len(childs)> 0:
+            self.logger.debug("Deleting all childs of curve %d"%delpk)
+            for child in childs:
+                child.delete()
+        self.logger.debug("Deleting curve %d" % delpk)
+        self._append_buffer = []
+        _appending_curves.discard(self)
+        self._remove()
+        if parent:
+            parentchilds = parent.params.get("childs") or []
+            if delpk in parentchilds:
+                parentchilds.remove(delpk)
+            parent.params["childs"] = parentchilds
+            parent.save()
+
+    def _remove(self):
+        """ removes the stored curve """
+        payload_cache.pop((self._dirname, self.pk))
+        base = os.path.join(self._dirname, str(self.pk))
+        filenames = [base + self.params_extension,
+                     base + self.file_extension] + \
+                    list(self._data_filenames()) + \
+                    self._all_chunk_filenames() + \
+                    self._all_level_filenames()
+        filenames = [f for f in filenames if os.path.exists(f)]
+        if len(filenames) == 0:
+            self.logger.warning("Could not find and remove the files of "
+                                "curve %s. ", self.pk)
+        for filename in filenames:
+            os.remove(filename)
+
+    # Implement the following methods if you want to use a hierarchical
+    # structure for curves
+    @property
+    def childs(self):
+        try:
+            childs = self.params["childs"]
+        except KeyError:
+            return []
+        if childs is None:
+            return []
+        else:
             try:
-                parentid = self.params["parent"]
+                return type(self).get(childs)
             except KeyError:
-                self.logger.debug("No parent found.")
-                return None
-            else:
-                return CurveDB.get(parentid)
+                return []
 
-        def add_child(self, child_curve):
-            child = CurveDB.get(child_curve)
-            child.params["parent"] = self.pk
+    @property
+    def parent(self):
+        try:
+            parentid = self.params["parent"]
+        except KeyError:
+            self.logger.debug("No parent found.")
+            return None
+        else:
+            return type(self).get(parentid)
+
+    def add_child(self, child_curve):
+        child = type(self).get(child_curve)
+        # curves that are being saved in the background are updated in the
+        # background, too, which coalesces with the pending saves
+        background = self.saving or child.saving
+        child.params["parent"] = self.pk
+        if background:
+            child.save_async()
+        else:
             child.save()
-            childs = self.params["childs"] or []
-            self.params["childs"] = list(childs+[child.pk])
+        childs = self.params["childs"] or []
+        self.params["childs"] = list(childs+[child.pk])
+        if background:
+            self.save_async()
+        else:
             self.save()
 
-        @classmethod
-        def all_pks(cls):
-            """
-            Returns:
-                list of int: A list of the primary keys of all CurveDB objects on the computer.
-            """
-            pks = [int(f.split('.dat')[0])
-                   for f in os.listdir(cls._dirname) if f.endswith('.dat')]
-            return sorted(pks, reverse=True)
-
-        @classmethod
-        def all(cls):
-            """
-            Returns:
-                list of CurveDB: A list of all CurveDB objects on the computer.
-            """
-            return [cls.get(pk) for pk in cls.all_pks()]
-
-        @property
-        def pk(self):
-            """
-            (int): The primary Key of the
-            """
-            if hasattr(self, "_pk"):
-                return self._pk
-            else:
-                pks = self.all_pks()
-                if len(pks) == 0:
-                    self._pk = 1
-                else:
-                    self._pk = max(pks) + 1
-                # create the file to make this pk choice persistent
-                with open(os.path.join(self._dirname,
-                                       str(self._pk) + ".dat"), 'w') as f:
-                    f.close()
-                return self._pk
-            return -1
-            # a proper implementation will assign the database primary key for pk
-            # the primary key is used to load a curve from the storage into memory
-
-        def sort(self):
-            """numerically sorts the data series so that indexing can be used"""
-            X, Y = self.data
-            xs = np.array([x for (x, y) in sorted(zip(X, Y))], dtype=np.float64)
-            ys = np.array([y for (x, y) in sorted(zip(X, Y))], dtype=np.float64)
-            self.data = (xs, ys)
-
-        def fit(self):
-            """ prototype for fitting a curve """
-            self.logger.warning("Not implemented")
-            pass
+    @classmethod
+    def all_pks(cls):
+        """
+        Returns:
+            list of int: A list of the primary keys of all CurveDB objects on the computer.
+        """
+        pks = set()
+        for f in os.listdir(cls._dirname):
+            for extension in [cls.params_extension, cls.file_extension]:
+                if f.endswith(extension):
+                    try:
+                        pks.add(int(f[:-len(extension)]))
+                    except ValueError:
+                        pass
+        return sorted(pks, reverse=True)
+
+    @classmethod
+    def all(cls):
+        """
+        Returns:
+            list of CurveDB: A list of all CurveDB objects on the computer.
+        """
+        return [cls.get(pk) for pk in cls.all_pks()]
+
+    @classmethod
+    def query(cls, name=None, parent=None, created_after=None,
+              created_before=None, **params):
+        """
+        Returns the pks (most recent first) of all curves that match the
+        given criteria. Only the params of the curves are loaded.
+
+        Args:
+            name (str): name of the curve, may contain the wildcards of
+                fnmatch (e.g. 'na_*')
+            parent (int): pk of the parent curve
+            created_after (float): minimum creation time (time.time() format)
+            created_before (float): maximum creation time
+            params: curve params that must have the given values
+
+        Returns:
+            list of int: the primary keys of the matching curves.
+        """
+        pks = []
+        for pk in cls.all_pks():
+            try:
+                curve = cls.get(pk)
+            except (EOFError, IOError, ValueError,
+                    file_backend.UnpicklingError):
+                continue  # e.g. a pk without saved curve
+            if name is not None and \
+                    not fnmatch.fnmatchcase(str(curve.params.get('name')), name):
+                continue
+            if parent is not None and curve.params.get('parent') != parent:
+                continue
+            if any(key not in curve.params or curve.params[key] != value
+                   for key, value in params.items()):
+                continue
+            if created_after is not None or created_before is not None:
+                created = curve.params.get('created')
+                if created is None:
+                    # curves from older versions: the data files are
+                    # written upon creation of the curve
+                    filename = curve._data_filenames()[0]
+                    if not os.path.exists(filename):
+                        filename = os.path.join(
+                            cls._dirname, str(pk) + cls.params_extension)
+                    created = os.path.getmtime(filename)
+                if (created_after is not None and created < created_after) or \
+                        (created_before is not None and
+                         created > created_before):
+                    continue
+            pks.append(pk)
+        return pks
+
+    @classmethod
+    def export(cls, curves, filename):
+        """
+        Writes the data and params of several curves into a single .npz
+        file that can be read with numpy.load.
+
+        Curves whose x and y arrays have the same shapes and dtypes form a
+        group i, stored as 2D arrays 'x_i' and 'y_i' (one row per curve)
+        together with the pks of the curves in 'pks_i'. The params of all
+        curves are stored as a json-encoded dict {pk: params} in 'params'.
+
+        Args:
+            curves (list): curves or pks of the curves to export, e.g. the
+                result of query()
+            filename (str): name of the file to write
+        """
+        groups = OrderedDict()  # {(shapes, dtypes): [curves]}
+        params = OrderedDict()
+        for curve in cls.get(list(curves)):
+            x, y = [np.asarray(a) for a in curve.data]
+            key = (x.shape, y.shape, x.dtype.str, y.dtype.str)
+            groups.setdefault(key, []).append((curve.pk, x, y))
+            params[str(curve.pk)] = curve.params
+        arrays = dict(params=np.array(json.dumps(params,
+                                                 default=_json_default)))
+        for i, group in enumerate(groups.values()):
+            arrays['pks_%d' % i] = np.array([pk for pk, x, y in group])
+            arrays['x_%d' % i] = np.stack([x for pk, x, y in group])
+            arrays['y_%d' % i] = np.stack([y for pk, x, y in group])
+        with open(filename, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @property
+    def pk(self):
+        """
+        (int): The primary Key of the
+        """
+        if hasattr(self, "_pk"):
+            return self._pk
+        else:
+            self._pk = self._next_pk()
+            # create the file to make this pk choice persistent
+            with open(os.path.join(self._dirname,
+                                   str(self._pk) + self.params_extension),
+                      'w') as f:
+                f.close()
+            return self._pk
+        return -1
+        # a proper implementation will assign the database primary key for pk
+        # the primary key is used to load a curve from the storage into memory
+
+    @classmethod
+    def _next_pk(cls):
+        """
+        Returns a new primary key from the persistent counter in the file
+        .pk_counter. The counter is protected by a lock file, such that
+        several processes can safely create curves in the same directory.
+        """
+        filename = os.path.join(cls._dirname, '.pk_counter')
+        with FileLock(filename + '.lock'):
+            try:
+                with open(filename) as f:
+                    pk = int(f.read()) + 1
+            except (IOError, ValueError):
+                # no counter yet: initialize it once from the existing files
+                pks = cls.all_pks()
+                pk = (max(pks) + 1) if len(pks) > 0 else 1
+            # skip curves that were copied into the directory
+            while any(os.path.exists(os.path.join(cls._dirname, str(pk) + ext))
+                      for ext in [cls.params_extension, cls.file_extension]):
+                pk += 1
+            with open(filename, 'w') as f:
+                f.write(str(pk))
+        return pk
+
+    def sort(self):
+        """numerically sorts the data series so that indexing can be used"""
+        X, Y = self.data
+        xs = np.array([x for (x, y) in sorted(zip(X, Y))], dtype=np.float64)
+        ys = np.array([y for (x, y) in sorted(zip(X, Y))], dtype=np.float64)
+        self.data = (xs, ys)
+
+    def fit(self):
+        """ prototype for fitting a curve """
+        self.logger.warning("Not implemented")
+        pass
+
+    def get_child(self, name):
+        """
+        Returns the child of the curve with name 'name'
+
+        Arguments:
+            name (str): Name of the child curve to be retrieved. If
+                several childs have the same name, the first one is
+                returned.
+
+        Returns:
+            CurveDB: the child curve
+        """
+        for c in self.childs:
+            if c.name == name:
+                return c
+
 
-        def get_child(self, name):
-            """
-            Returns the child of the curve with name 'name'
-
-            Arguments:
-                name (str): Name of the child curve to be retrieved. If
-                    several childs have the same name, the first one is
-                    returned.
-
-            Returns:
-                CurveDB: the child curve
-            """
-            for c in self.childs:
-                if c.name == name:
-                    return c
+def _json_default(obj):
+    """ converts numpy and complex values in curve params for json """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, complex):
+        return str(obj)
+    raise TypeError("Cannot convert %s to json." % repr(obj))
+
+
+class SqliteCurveDB(CurveDB):
+    """
+    CurveDB backend that keeps an index of all curves in a SQLite database.
+
+    The table 'curves' of the file curves.sqlite holds the pk, name,
+    creation time, parent pk and json-encoded params of each curve. Listing
+    curves and querying them by name, creation time or parameter value
+    therefore never touches the curve data, which are stored separately
+    in the files <pk>.x.npy and <pk>.y.npy (see CurveDB). The pks are
+    allocated with the pk counter of CurveDB, and the row of a curve is
+    only written upon save, i.e. by the CurveSaver thread for
+    create_async() and save_async().
+
+    To use this backend, set 'curvedb: sqlite' in the section 'general' of
+    global_config.yml.
+    """
+    _dirname = os.path.join(user_curve_dir, 'sqlite')
+    db_filename = 'curves.sqlite'
+    _local = threading.local()  # one database connection per thread
+
+    @classmethod
+    def _connection(cls):
+        """ returns the database connection of the current thread """
+        filename = os.path.join(cls._dirname, cls.db_filename)
+        connections = cls._local.__dict__.setdefault('connections', {})
+        if filename not in connections:
+            if not os.path.exists(cls._dirname):
+                os.makedirs(cls._dirname)
+            connection = sqlite3.connect(filename, timeout=30.0)
+            connection.execute("CREATE TABLE IF NOT EXISTS curves ("
+                               "pk INTEGER PRIMARY KEY, "
+                               "name TEXT, "
+                               "created REAL, "
+                               "parent INTEGER, "
+                               "params TEXT)")
+            for column in ['name', 'created', 'parent']:
+                connection.execute("CREATE INDEX IF NOT EXISTS curves_%s "
+                                   "ON curves (%s)" % (column, column))
+            connection.commit()
+            connections[filename] = connection
+        return connections[filename]
+
+    @classmethod
+    def get(cls, curve):
+        if isinstance(curve, cls):
+            return curve
+        elif isinstance(curve, list):
+            return [cls.get(c) for c in curve]
+        pk = int(curve)
+        cls._wait_saved(pk)
+        row = cls._connection().execute(
+            "SELECT params FROM curves WHERE pk=?", (pk,)).fetchone()
+        if row is None:
+            raise KeyError("No curve with pk %s in %s." % (pk, cls._dirname))
+        curve = cls()
+        curve._pk = pk
+        curve.params = json.loads(row[0])
+        curve._data, curve._data_saved = None, True  # loaded if needed
+        return curve
+
+    def _save_params(self):
+        connection = self._connection()
+        values = (self.params.get('name'), self.params.get('parent'),
+                  json.dumps(self.params, default=_json_default))
+        with connection:
+            if connection.execute(
+                    "UPDATE curves SET name=?, parent=?, params=? WHERE pk=?",
+                    values + (self.pk,)).rowcount == 0:
+                connection.execute(
+                    "INSERT INTO curves (name, parent, params, pk, created) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    values + (self.pk,
+                              self.params.get('created', time.time())))
+
+    def _remove(self):
+        payload_cache.pop((self._dirname, self.pk))
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM curves WHERE pk=?", (self.pk,))
+        for filename in list(self._data_filenames()) + \
+                self._all_chunk_filenames() + \
+                self._all_level_filenames():
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    @property
+    def childs(self):
+        return self.get(self.query(parent=self.pk)[::-1])
+
+    @classmethod
+    def all_pks(cls):
+        """
+        Returns:
+            list of int: A list of the primary keys of all CurveDB objects on the computer.
+        """
+        return [row[0] for row in cls._connection().execute(
+            "SELECT pk FROM curves ORDER BY pk DESC")]
+
+    @property
+    def pk(self):
+        """
+        (int): The primary Key of the curve, allocated upon the first call.
+        The row of the curve in the index is written by _save_params().
+        """
+        if not hasattr(self, "_pk"):
+            if not os.path.exists(self._dirname):
+                os.makedirs(self._dirname)
+            self._pk = self._next_pk()
+        return self._pk
+
+    @classmethod
+    def query(cls, name=None, parent=None, created_after=None,
+              created_before=None, **params):
+        """
+        Returns the pks (most recent first) of all curves that match the
+        given criteria, without loading any curve.
+
+        Args:
+            name (str): name of the curve, may contain the wildcards of
+                fnmatch (e.g. 'na_*')
+            parent (int): pk of the parent curve
+            created_after (float): minimum creation time (time.time() format)
+            created_before (float): maximum creation time
+            params: curve params that must have the given values
+
+        Returns:
+            list of int: the primary keys of the matching curves.
+        """
+        conditions, values = [], []
+        for column, operator, value in [('name', 'GLOB', name),
+                                        ('parent', '=', parent),
+                                        ('created', '>=', created_after),
+                                        ('created', '<=', created_before)]:
+            if value is not None:
+                conditions.append('%s %s ?' % (column, operator))
+                values.append(value)
+        for key, value in params.items():
+            conditions.append("json_extract(params, ?) = ?")
+            values += ['$."%s"' % key, value]
+        sql = "SELECT pk FROM curves"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY pk DESC"
+        return [row[0] for row in cls._connection().execute(sql, values)]
+
+
+# optional override of CurveDB class with a custom module or the sqlite
+# backend, as defined in ./pyrpl/config/global_config.yml
+try:
+    from . import global_config
+    _curvedb = global_config.general.curvedb
+except:
+    _curvedb = 'pyrpl'
+if _curvedb == 'sqlite':
+    CurveDB = SqliteCurveDB
+elif _curvedb != 'pyrpl':
+    try:
+        CurveDB = __import__(_curvedb).CurveDB
+    except:
+        logger.warning("Could not import CurveDB from module %s. Using the "
+                       "default pyrpl CurveDB instead.", _curvedb)
@@ -2,6 +2,7 @@ import numpy as np
 from qtpy import QtCore
 from ..attributes import FloatProperty, BoolRegister, FloatRegister, GainRegister
 from ..modules import SignalLauncher
+from ..async_utils import MainThreadTimer
 from . import FilterModule
 from ..widgets.module_widgets import PidWidget
 
@@ -29,9 +30,8 @@ class SignalLauncherPid(SignalLauncher):
     # depending on the visibility
     def __init__(self, module):
         super(SignalLauncherPid, self).__init__(module)
-        self.timer_ival = QtCore.QTimer()
-        self.timer_ival.setInterval(1000)  # max. refresh rate: 1 Hz
-        self.timer_ival.timeout.connect(self.update_ival)
+        self.timer_ival = MainThreadTimer(1000)  # max. refresh rate: 1 Hz
+        self.timer_ival.timeout.connect(self.update_ival.emit)
         self.timer_ival.setSingleShot(False)
         self.timer_ival.start()
 
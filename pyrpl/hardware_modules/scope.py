@@ -2,6 +2,7 @@ import time
 from .dsp import all_inputs, dsp_addr_base, InputSelectRegister
 from ..acquisition_module import AcquisitionModule
 from ..async_utils import MainThreadTimer, PyrplFuture, sleep
+from ..curvedb import CurveDB
 from ..pyrpl_utils import sorted_dict
 from ..attributes import *
 from ..modules import HardwareModule
@@ -27,6 +28,7 @@ class DecimationRegister(SelectRegister):
     """
     def set_value(self, obj, value):
         SelectRegister.set_value(self, obj, value)
+        obj._invalidate_times()
         obj.__class__.duration.value_updated(obj, obj.duration)
         obj.__class__.sampling_time.value_updated(obj, obj.sampling_time)
         # instance.setup()
@@ -128,6 +130,154 @@ class ContinuousRollingFuture(PyrplFuture):
         pass
 
 
+class ScopeStream(object):
+    """
+    Continuously transfers all samples acquired by the scope in rolling mode,
+    turning the scope into a data logger of unlimited length.
+
+    The write pointer and the 64 bit timestamp of the scope are polled
+    regularly, and only the new samples are read. If the polling was too
+    slow to catch up with the acquisition (e.g. because the event loop was
+    blocked), the overwritten samples are lost. Such gaps are detected with
+    the timestamp and reported in the list gaps.
+
+    The samples are collected into chunks of chunk_size samples, which are
+    appended to the CurveDB curves in curves (if save is True) and passed
+    to callback(times, datas), where datas has the shape (2, len(times)).
+    Times are given in seconds since the start of the stream. The curves
+    are written by the CurveSaver thread and must not be accessed before
+    stop() has returned.
+
+    If an error occurs while polling (e.g. the connection is lost, or the
+    decimation of the scope has been changed, which would change the
+    sampling time), it is logged and stored in error, and polling stops.
+    Call stop() to pass on the samples that were read before.
+
+    Attributes:
+        n_samples (int): number of samples since the start, including lost
+            samples
+        gaps (list): (sample index, number of lost samples) of each gap
+        curves (list): the curves of the active channels
+        error (Exception): the error that stopped the stream, or None
+    """
+    MAX_POLL_INTERVAL_MS = 100
+
+    def __init__(self, module, callback=None, save=True,
+                 chunk_size=data_length // 2):
+        self._module = module
+        self.callback = callback
+        self.chunk_size = chunk_size
+        self.channels = [ch for ch, active in ((0, module.ch1_active),
+                                               (1, module.ch2_active))
+                         if active]
+        self.n_samples = 0
+        self.gaps = []
+        self.curves = []
+        self.error = None
+        if save:
+            params = module.setup_attributes
+            for ch in self.channels:
+                params.update(ch=ch, name=module.curve_name + ' stream ch' +
+                                          str(ch + 1))
+                self.curves.append(CurveDB.create(**params))
+        self._chunks = []  # [(times, datas)] not yet passed on
+        self._decimation = int(module.decimation)
+        self._sampling_time = module.sampling_time
+        # poll often enough to read the buffer before it is overwritten
+        interval = min(self.MAX_POLL_INTERVAL_MS,
+                       int(module.duration * 1000 / 4))
+        self._timer = MainThreadTimer(interval)
+        self._timer.timeout.connect(self._poll)
+
+    def _pointers(self):
+        """ returns the current write pointer and timestamp of the scope """
+        wp, ts, decimation = self._module._reads_batch([(0x18, 1),
+                                                        (0x15C, 2),
+                                                        (0x14, 1)])
+        if int(decimation[0]) != self._decimation:
+            raise ValueError("The decimation of the scope has changed "
+                             "from %d to %d." % (self._decimation,
+                                                 int(decimation[0])))
+        return int(wp[0]), int(ts[0]) + (int(ts[1]) << 32)
+
+    def start(self):
+        self._module._start_acquisition_rolling_mode()
+        self._wp, self._timestamp = self._pointers()
+        self._timer.start()
+
+    def stop(self):
+        """ stops the stream, passes on the remaining samples and waits
+        until the curves are written """
+        self._timer.stop()
+        self._flush()
+        futures = [curve.append_async([], [], flush=True)
+                   for curve in self.curves]
+        for future in futures:
+            future.result()
+
+    def _poll(self):
+        try:
+            self._read_new_samples()
+        except Exception as e:
+            self.error = e
+            self._timer.stop()
+            self._module._logger.error("Scope stream stopped after sample "
+                                       "%d because of an error: %s",
+                                       self.n_samples, e)
+        else:
+            self._timer.start()
+
+    def _read_new_samples(self):
+        """ transfers the samples written since the last poll """
+        module, length = self._module, self._module.data_length
+        wp, timestamp = self._pointers()
+        n = (wp - self._wp) % length
+        # the timestamp counts clock cycles, i.e. decimation per sample
+        n_elapsed = int(round(float(timestamp - self._timestamp)
+                              / self._decimation))
+        if n_elapsed > n + length // 2:  # the buffer has wrapped around
+            # samples written during the transfer must not be read
+            n = length - length // 8
+            lost = n_elapsed - n
+            module._logger.warning("Scope stream lost %d samples after "
+                                   "sample %d.", lost, self.n_samples)
+            self.gaps.append((self.n_samples, lost))
+            self.n_samples += lost
+        if n > 0:
+            start = (wp - n + 1) % length
+            ranges = [(start, min(n, length - start))]
+            if start + n > length:
+                ranges.append((0, start + n - length))
+            requests = [(ch, begin, size) for ch in self.channels
+                        for begin, size in ranges]
+            datas = np.zeros((2, n))
+            reads = module._reads_batch([(0x10000 * (ch + 1) + 4 * begin,
+                                          size)
+                                         for ch, begin, size in requests])
+            for (ch, begin, size), data in zip(requests, reads):
+                offset = (begin - start) % length
+                datas[ch, offset:offset + size] = \
+                    module._to_signed(data) / 2. ** 13
+            times = (self.n_samples + np.arange(n)) * self._sampling_time
+            self._chunks.append((times, datas))
+            self.n_samples += n
+        self._wp, self._timestamp = wp, timestamp
+        if sum(len(times) for times, datas in self._chunks) >= \
+                self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._chunks) == 0:
+            return
+        times = np.concatenate([t for t, d in self._chunks])
+        datas = np.concatenate([d for t, d in self._chunks], axis=1)
+        self._chunks = []
+        for ch, curve in zip(self.channels, self.curves):
+            curve.append_async(times, datas[ch])  # no disc access here
+        if self.callback is not None:
+            self.callback(times, datas)
+
+
 class Scope(HardwareModule, AcquisitionModule):
     addr_base = 0x40100000
     name = 'scope'
@@ -147,7 +297,8 @@ class Scope(HardwareModule, AcquisitionModule):
                        "ch2_active",
                        "xy_mode"]
     # running_state last for proper acquisition setup
-    _setup_attributes = _gui_attributes + ["rolling_mode", "running_state"]
+    _setup_attributes = _gui_attributes + ["rolling_mode", "data_type",
+                                           "running_state"]
     # changing these resets the acquisition and autoscale (calls setup())
 
     data_length = data_length  # to use it in a list comprehension
@@ -372,10 +523,30 @@ class Scope(HardwareModule, AcquisitionModule):
     ch2_active = BoolProperty(default=True,
                               doc="should ch2 be displayed in the gui?")
 
+    data_type = SelectProperty(options=['float64', 'float32'],
+                               default='float64',
+                               doc="numpy dtype of the acquired curves. "
+                                   "float32 halves memory and CPU per "
+                                   "curve, see also get_raw_curve().")
+
+    raw_scale = 1. / 2 ** 13  # volts per unit of the raw int16 data
+
     xy_mode = BoolProperty(default=False,
                            doc="in xy-mode, data are plotted vs the other "
                                "channel (instead of time)")
 
+    # host-side copy of the scope buffers for rolling mode
+    _rolling_write_pointer = None
+    # cached time axes
+    _times = None
+    _rolling_times = None
+    # curves are fetched in the acquisition thread, which also re-arms the
+    # scope between the curves of a run (see _rearm_acquisition)
+    _threaded_acquisition = True
+    _rearm_in_thread = True
+    # the curves of a run are fetched into the same array (see _get_curve)
+    _get_curve_into_out = True
+
     def _ownership_changed(self, old, new):
         """
         If the scope was in continuous mode when slaved, it has to stop!!
@@ -388,19 +559,54 @@ class Scope(HardwareModule, AcquisitionModule):
         """raw data from ch1"""
         # return np.array([self.to_pyint(v) for v in self._reads(0x10000,
         # self.data_length)],dtype=np.int32)
-        x = np.array(self._reads(0x10000, self.data_length), dtype=np.int16)
-        x[x >= 2 ** 13] -= 2 ** 14
-        return x
+        return self._to_signed(self._reads(0x10000, self.data_length))
 
     @property
     def _rawdata_ch2(self):
         """raw data from ch2"""
         # return np.array([self.to_pyint(v) for v in self._reads(0x20000,
         # self.data_length)],dtype=np.int32)
-        x = np.array(self._reads(0x20000, self.data_length), dtype=np.int16)
+        return self._to_signed(self._reads(0x20000, self.data_length))
+
+    def _fetch(self):
+        """
+        Reads the trigger delay, decimation and write pointer registers
+        together with the data of both channels in one batched transfer.
+
+        Returns:
+            tuple: (registers, rawdata) with registers the list
+            [_trigger_delay_register, decimation, _write_pointer_current,
+            _write_pointer_trigger] and rawdata the (2, data_length) array
+            of signed raw data of both channels.
+        """
+        # the buffers of ch1 (0x10000) and ch2 (0x20000) are contiguous
+        registers, data = self._reads_batch([(0x10, 4),
+                                             (0x10000, 2 * self.data_length)])
+        rawdata = self._to_signed(data).reshape(2, self.data_length)
+        return [int(v) for v in registers], rawdata
+
+    @staticmethod
+    def _to_signed(data):
+        """ converts raw 14 bit data from the scope buffer to int16 """
+        x = np.array(data, dtype=np.int16)
         x[x >= 2 ** 13] -= 2 ** 14
         return x
 
+    @staticmethod
+    def _roll_into(rawdata, shift, out, scale=None):
+        """
+        Writes rawdata rolled by -shift along the last axis (and multiplied
+        by scale) into the array out, without intermediate copies.
+        """
+        n = rawdata.shape[-1] - shift
+        if scale is None:
+            out[..., :n] = rawdata[..., shift:]
+            out[..., n:] = rawdata[..., :shift]
+        else:
+            np.multiply(rawdata[..., shift:], scale, out=out[..., :n])
+            np.multiply(rawdata[..., :shift], scale, out=out[..., n:])
+        return out
+
     @property
     def _data_ch1(self):
         """ acquired (normalized) data from ch1"""
@@ -433,18 +639,47 @@ class Scope(HardwareModule, AcquisitionModule):
 
     @property
     def times(self):
-        # duration = 8e-9*self.decimation*self.data_length
-        # endtime = duration*
-        duration = self.duration
-        trigger_delay = self.trigger_delay
-        if self.trigger_source!='immediately':
-            return np.linspace(trigger_delay - duration / 2.,
-                               trigger_delay + duration / 2.,
-                               self.data_length, endpoint=False)
-        else:
-            return np.linspace(0,
-                               duration,
-                               self.data_length, endpoint=False)
+        """
+        Time axis of the curves [s].
+
+        The (read-only) array is cached and only recomputed after a change
+        of decimation, trigger_delay or trigger_source.
+        """
+        if self._times is None:
+            # duration = 8e-9*self.decimation*self.data_length
+            # endtime = duration*
+            duration = self.duration
+            trigger_delay = self.trigger_delay
+            if self.trigger_source!='immediately':
+                times = np.linspace(trigger_delay - duration / 2.,
+                                    trigger_delay + duration / 2.,
+                                    self.data_length, endpoint=False)
+            else:
+                times = np.linspace(0,
+                                    duration,
+                                    self.data_length, endpoint=False)
+            times.setflags(write=False)
+            self._times = times
+        return self._times
+
+    @property
+    def _times_rolling(self):
+        """ cached time axis of rolling mode (0 for the latest sample) """
+        if self._rolling_times is None:
+            times = self.times - self.times[-1]
+            times.setflags(write=False)
+            self._rolling_times = times
+        return self._rolling_times
+
+    def _invalidate_times(self):
+        self._times = None
+        self._rolling_times = None
+
+    def _setup(self):
+        # trigger_delay, trigger_source and decimation call setup() when
+        # they change
+        self._invalidate_times()
+        super(Scope, self)._setup()
 
 
     def wait_for_pretrigger(self):
@@ -480,11 +715,35 @@ class Scope(HardwareModule, AcquisitionModule):
     def data_x(self):
         return self.times
 
-    def _get_curve(self):
+    def _get_curve(self, out=None):
         """
-        Simply pack together channel 1 and channel 2 curves in a numpy array
+        Returns the curves of channel 1 and channel 2 in a numpy array of
+        type data_type, fetched in a single transfer from the redpitaya.
+        The curves are written into out if it is given.
         """
-        return np.array((self._get_ch(1), self._get_ch(2)))
+        (delay, decimation, wp_current, wp_trigger), rawdata = self._fetch()
+        if out is None:
+            out = np.empty((2, self.data_length), dtype=self.data_type)
+        return self._roll_into(rawdata,
+                               (wp_trigger + delay + 1) % self.data_length,
+                               out, scale=self.raw_scale)
+
+    def get_raw_curve(self, out=None):
+        """
+        Returns the last acquired curves of both channels as raw int16 data
+        (without conversion to float), e.g. for fast data logging.
+
+        :param out: int16 array of shape (2, data_length) to write the data
+        into. A new array is created if None.
+        :return: (rawdata, raw_scale), where rawdata * raw_scale are the
+        curves in volts.
+        """
+        (delay, decimation, wp_current, wp_trigger), rawdata = self._fetch()
+        if out is None:
+            out = np.empty((2, self.data_length), dtype=np.int16)
+        return self._roll_into(rawdata,
+                               (wp_trigger + delay + 1) % self.data_length,
+                               out), self.raw_scale
 
     def _remaining_time(self):
         """
@@ -536,10 +795,23 @@ class Scope(HardwareModule, AcquisitionModule):
         self._autosave_active = autosave_backup
         self._last_time_setup = time()
 
+    def _rearm_acquisition(self):
+        """
+        Re-arms the trigger for the next curve of a run, with the trigger
+        delay of the last call to _start_acquisition(). Called from the
+        acquisition thread, so the registers are written directly instead
+        of through their attributes, which would emit signals.
+        """
+        self._write(0x0, 1)  # arm the trigger (see _trigger_armed)
+        # in mode 'immediately', this causes a software trigger
+        self._write(0x4, self._trigger_sources[self.trigger_source])
+        return self.duration
+
     # Rolling_mode related methods:
     # -----------------------------
 
     def _start_acquisition_rolling_mode(self):
+        self._rolling_write_pointer = None  # next curve reads all data
         self._start_acquisition()
         self._trigger_source_register = 'off'
         self._trigger_armed = True
@@ -563,32 +835,151 @@ class Scope(HardwareModule, AcquisitionModule):
             self._rawdata_ch2 * 1. / 2 ** 13
 
     def _get_rolling_curve(self):
-        datas = np.zeros((2, len(self.times)))
-        # Rolling mode
-        wp0 = self._write_pointer_current  # write pointer
-        # before acquisition
-        times = self.times
-        times -= times[-1]
-
-        for ch, active in (
-                (0, self.ch1_active),
-                (1, self.ch2_active)):
-            if active:
-                datas[ch] = self._get_ch_no_roll(ch + 1)
-        wp1 = self._write_pointer_current  # write pointer after
-        #  acquisition
-        for index, active in [(0, self.ch1_active),
-                              (1, self.ch2_active)]:
-            if active:
-                data = datas[index]
-                to_discard = (wp1 - wp0) % self.data_length  # remove
-                #  data that have been affected during acq.
-                data = np.roll(data, self.data_length - wp0)[
-                       to_discard:]
-                data = np.concatenate([[np.nan] * to_discard, data])
-                datas[index] = data
+        """
+        Returns (times, datas) of the rolling mode display.
+
+        A copy of the scope buffers is kept in self._rolling_buffer. Only the
+        samples written since the previous call are transferred and inserted
+        into this copy, unless the whole buffer may have been overwritten
+        in the meantime. If the write pointer has not moved (e.g. with
+        the DummyClient, or if the acquisition was stopped), the full
+        buffers are read such that the display does not freeze.
+        """
+        times = self._times_rolling
+        channels = [ch for ch, active in ((0, self.ch1_active),
+                                          (1, self.ch2_active)) if active]
+        wp = self._write_pointer_current
+        now = time()
+        if self._rolling_write_pointer is None or \
+                wp == self._rolling_write_pointer or \
+                channels != self._rolling_channels or \
+                now - self._rolling_time > 0.5 * self.duration:
+            self._get_rolling_buffer(channels, wp)
+        else:
+            self._update_rolling_buffer(channels, wp)
+        self._rolling_time = now
+        datas = np.roll(self._rolling_buffer, -(wp + 1), axis=1)
         return times, datas
 
+    def _get_rolling_buffer(self, channels, wp0):
+        """ reads the full buffers of all channels """
+        buffer = np.zeros((2, self.data_length))
+        datas = self._reads_batch([(0x10000 * (ch + 1), self.data_length)
+                                   for ch in channels])
+        for ch, data in zip(channels, datas):
+            buffer[ch] = self._to_signed(data) / 2. ** 13
+        wp1 = self._write_pointer_current  # write pointer after acquisition
+        # samples after wp0 that were written during the transfer are not
+        # valid. They are read at the next call.
+        to_discard = (wp1 - wp0) % self.data_length
+        buffer[channels, wp0 + 1:wp0 + 1 + to_discard] = np.nan
+        buffer[channels, :max(0, wp0 + 1 + to_discard - self.data_length)] \
+            = np.nan
+        self._rolling_buffer = buffer
+        self._rolling_channels = channels
+        self._rolling_write_pointer = wp0
+
+    def _update_rolling_buffer(self, channels, wp):
+        """ reads the samples written since the last call in-place into
+        self._rolling_buffer """
+        start = (self._rolling_write_pointer + 1) % self.data_length
+        n = (wp - self._rolling_write_pointer) % self.data_length
+        if n == 0:
+            return
+        # the new samples may wrap around the end of the buffer
+        ranges = [(start, min(n, self.data_length - start))]
+        if start + n > self.data_length:
+            ranges.append((0, start + n - self.data_length))
+        requests = [(ch, begin, length) for ch in channels
+                    for begin, length in ranges if length > 0]
+        datas = self._reads_batch([(0x10000 * (ch + 1) + 4 * begin, length)
+                                   for ch, begin, length in requests])
+        for (ch, begin, length), data in zip(requests, datas):
+            self._rolling_buffer[ch, begin:begin + length] = \
+                self._to_signed(data) / 2. ** 13
+        self._rolling_write_pointer = wp
+
+    def stream(self, callback=None, save=True, chunk_size=data_length // 2):
+        """
+        Starts to continuously transfer the acquired samples of the active
+        channels (see ScopeStream). Any running acquisition is stopped.
+
+        :param callback: function callback(times, datas) that is called with
+        each chunk of samples
+        :param save: if True, the samples are appended to a CurveDB curve
+        for each active channel
+        :param chunk_size: number of samples per chunk
+        :return: the ScopeStream object. Call its stop() method to stop
+        streaming.
+        """
+        if not self._rolling_mode_allowed():
+            raise ValueError("Streaming requires a duration longer than "
+                             "0.1 s.")
+        self.stop()
+        stream = ScopeStream(self, callback=callback, save=save,
+                             chunk_size=chunk_size)
+        stream.start()
+        return stream
+
+    def acquire_segments(self, n_segments, timeout=None, trigger_interval=1.):
+        """
+        Acquires n_segments consecutive triggered curves as fast as
+        possible, without the event loop: the trigger is re-armed by a
+        single batched transfer immediately after the data of the previous
+        segment have been read. The current setup (trigger_source,
+        trigger_delay, duration, ...) is used. Any running acquisition is
+        stopped.
+
+        :param n_segments: number of curves to acquire
+        :param timeout: maximum duration of the acquisition in seconds. If
+        it expires, only the segments acquired so far are returned. By
+        default, each segment may take the time of one curve
+        (duration + trigger_delay) plus trigger_interval.
+        :param trigger_interval: the expected maximum time in seconds
+        between two triggers (including the transfer of one segment), only
+        used to compute the default timeout.
+        :return: (timestamps, datas), with timestamps the int64 array of the
+        trigger_timestamp of each segment in clock cycles (8 ns) and datas
+        the array of shape (n_segments, 2, data_length) and type data_type
+        with the normalized data of both channels. The time axis is given by
+        times.
+        """
+        self.stop()
+        timestamps = np.zeros(n_segments, dtype=np.int64)
+        datas = np.empty((n_segments, 2, self.data_length),
+                         dtype=self.data_type)
+        source = self._trigger_sources[self.trigger_source]
+        if timeout is None:
+            timeout = n_segments * (self.duration + max(self.trigger_delay, 0)
+                                    + trigger_interval)
+        start = time()
+        self._start_acquisition()
+        for k in range(n_segments):
+            # wait for the trigger (bit 0) and the trigger delay (bit 2)
+            status = self._read(0x0)
+            while status & 0b101:
+                if time() - start > timeout:
+                    self._logger.warning("Timeout after %d of %d segments.",
+                                         k, n_segments)
+                    return timestamps[:k], datas[:k]
+                status = self._read(0x0)
+            registers, timestamp, data = self._reads_batch(
+                [(0x10, 4), (0x164, 2), (0x10000, 2 * self.data_length)])
+            if k + 1 < n_segments:
+                # re-arm: reset write state machine (bit 1), arm trigger
+                # (bit 0), and set the trigger source (again)
+                self._writes_batch([(0x0, [(status & ~0b111) | 0b010]),
+                                    (0x0, [(status & ~0b111) | 0b001]),
+                                    (0x4, [source])])
+            delay, decimation, wp_current, wp_trigger = \
+                [int(v) for v in registers]
+            timestamps[k] = int(timestamp[0]) + (int(timestamp[1]) << 32)
+            rawdata = self._to_signed(data).reshape(2, self.data_length)
+            self._roll_into(rawdata,
+                            (wp_trigger + delay + 1) % self.data_length,
+                            datas[k], scale=self.raw_scale)
+        return timestamps, datas
+
     # Custom behavior of AcquisitionModule methods for scope:
     # -------------------------------------------------------
 
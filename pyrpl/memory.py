@@ -17,12 +17,18 @@
 ###############################################################################
 
 import os
+import atexit
+import hashlib
+import pickle
+import threading
+import weakref
 from collections import OrderedDict
 from shutil import copyfile
 import numpy as np
 import time
 from qtpy import QtCore
 from . import default_config_dir, user_config_dir
+from .async_utils import MainThreadTimer, LOOP_BACKEND
 from .pyrpl_utils import time
 
 import logging
@@ -63,41 +69,59 @@ except:
     logger.debug("ruamel.yaml could not be imported. Using yaml instead. "
                  "Comments in config files will be lost.")
     import yaml
+    # the libyaml bindings are an order of magnitude faster than the pure
+    # python implementation, but they are not always installed
+    try:
+        from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+    except ImportError:
+        from yaml import SafeLoader, SafeDumper
 
     # see http://stackoverflow.com/questions/13518819/avoid-references-in-pyyaml
     #yaml.Dumper.ignore_aliases = lambda *args: True # NEVER TESTED
 
     # ordered load and dump for yaml files. From
     # http://stackoverflow.com/questions/5121931/in-python-how-can-you-load-yaml-mappings-as-ordereddicts
-    def load(stream, Loader=yaml.SafeLoader, object_pairs_hook=OrderedDict):
-        class OrderedLoader(Loader):
-            pass
-        def construct_mapping(loader, node):
-            loader.flatten_mapping(node)
-            return object_pairs_hook(loader.construct_pairs(node))
-        OrderedLoader.add_constructor(
-            yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-            construct_mapping)
+    # the customized Loader and Dumper classes are only created once
+    _ordered_loaders = {}
+    _ordered_dumpers = {}
+
+    def load(stream, Loader=SafeLoader, object_pairs_hook=OrderedDict):
+        try:
+            OrderedLoader = _ordered_loaders[(Loader, object_pairs_hook)]
+        except KeyError:
+            class OrderedLoader(Loader):
+                pass
+            def construct_mapping(loader, node):
+                loader.flatten_mapping(node)
+                return object_pairs_hook(loader.construct_pairs(node))
+            OrderedLoader.add_constructor(
+                yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+                construct_mapping)
+            _ordered_loaders[(Loader, object_pairs_hook)] = OrderedLoader
         return yaml.load(stream, OrderedLoader)
-    def save(data, stream=None, Dumper=yaml.SafeDumper,
+    def save(data, stream=None, Dumper=SafeDumper,
              default_flow_style=False,
              encoding='utf-8',
              **kwds):
-        class OrderedDumper(Dumper):
-            pass
-        def _dict_representer(dumper, data):
-            return dumper.represent_mapping(
-                yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-                data.items())
-        OrderedDumper.add_representer(OrderedDict, _dict_representer)
-        OrderedDumper.add_representer(np.float64,
-                    lambda dumper, data: dumper.represent_float(float(data)))
-        OrderedDumper.add_representer(complex,
-                    lambda dumper, data: dumper.represent_str(str(data)))
-        OrderedDumper.add_representer(np.complex128,
-                    lambda dumper, data: dumper.represent_str(str(data)))
-        OrderedDumper.add_representer(np.ndarray,
-                    lambda dumper, data: dumper.represent_list(list(data)))
+        try:
+            OrderedDumper = _ordered_dumpers[Dumper]
+        except KeyError:
+            class OrderedDumper(Dumper):
+                pass
+            def _dict_representer(dumper, data):
+                return dumper.represent_mapping(
+                    yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+                    data.items())
+            OrderedDumper.add_representer(OrderedDict, _dict_representer)
+            OrderedDumper.add_representer(np.float64,
+                        lambda dumper, data: dumper.represent_float(float(data)))
+            OrderedDumper.add_representer(complex,
+                        lambda dumper, data: dumper.represent_str(str(data)))
+            OrderedDumper.add_representer(np.complex128,
+                        lambda dumper, data: dumper.represent_str(str(data)))
+            OrderedDumper.add_representer(np.ndarray,
+                        lambda dumper, data: dumper.represent_list(list(data)))
+            _ordered_dumpers[Dumper] = OrderedDumper
         # I added the following two lines to make pyrpl compatible with pyinstruments. In principle they can be erased
         if isinstance(data, dict) and not isinstance(data, OrderedDict):
             data = OrderedDict(data)
@@ -113,10 +137,165 @@ except:
     # save(data, stream=f, Dumper=yaml.SafeDumper)
 
 
+def load_file(filename):
+    """
+    returns the parsed content of the yml file filename.
+
+    Parsing large yml files is slow, therefore the parsed tree is pickled
+    into a cache file next to the yml file. The cache is only used if the
+    size, modification time and hash of the yml file are unchanged.
+    """
+    cache_filename = filename + '.cache'
+    stat = os.stat(filename)
+    with open(filename, 'rb') as f:
+        content = f.read()
+    key = (stat.st_size, stat.st_mtime, hashlib.sha1(content).hexdigest())
+    try:
+        with open(cache_filename, 'rb') as f:
+            cached_key, data = pickle.load(f)
+    except Exception:  # cache file missing, outdated or corrupted
+        pass
+    else:
+        if cached_key == key:
+            logger.debug("Loaded config file %s from cache", filename)
+            return data
+    data = load(content)
+    # make the cache for the next call (atomic write as in MemoryTree)
+    try:
+        with open(cache_filename + '.tmp', 'wb') as f:
+            pickle.dump((key, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(cache_filename):
+            os.unlink(cache_filename)
+        os.rename(cache_filename + '.tmp', cache_filename)
+    except Exception as e:
+        logger.debug("Could not write cache file %s: %s", cache_filename, e)
+    return data
+
+
 def isbranch(obj):
     return isinstance(obj, dict) or isinstance(obj, list)
 
 
+def equal(a, b):
+    """ returns True if a and b are (nested) values that would be
+    represented identically in the config file """
+    if isinstance(a, dict) and isinstance(b, dict):
+        return len(a) == len(b) and \
+               all(k in b and equal(v, b[k]) for k, v in a.items())
+    elif isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    elif isbranch(a) or isbranch(b) or type(a) is not type(b):
+        return False
+    try:
+        return bool(a == b)
+    except Exception:  # e.g. numpy arrays
+        return False
+
+
+def snapshot(data):
+    """ returns a copy of the nested dicts and lists in data.
+
+    Leaves are not copied since they are never modified in place by the
+    MemoryTree. The snapshot can therefore be serialized in another thread
+    while the original data keeps being modified. """
+    if isinstance(data, dict):
+        return type(data)((k, snapshot(v)) for k, v in data.items())
+    elif isinstance(data, list):
+        return [snapshot(v) for v in data]
+    else:
+        return data
+
+
+class ConfigWriter(threading.Thread):
+    """
+    A thread that writes config files in the background.
+
+    Only the most recent snapshot of each MemoryTree is kept in the queue,
+    such that several changes of the same tree that occur before the
+    thread gets to work result in a single write operation. Each snapshot
+    carries the generation number of the write, such that a snapshot that
+    was superseded by a synchronous write in the meantime is dropped.
+    """
+    def __init__(self):
+        super(ConfigWriter, self).__init__(name="pyrpl_config_writer")
+        self.daemon = True
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()  # {id(tree): (tree, data, generation)}
+        self._busy = None  # the tree that is currently being written
+
+    def submit(self, tree, data, generation):
+        """ schedules writing data to the file of tree """
+        with self._condition:
+            self._pending[id(tree)] = (tree, data, generation)
+            self._condition.notify_all()
+
+    def discard(self, tree):
+        """ removes a pending (not yet started) write of tree """
+        with self._condition:
+            self._pending.pop(id(tree), None)
+
+    def wait(self, tree=None):
+        """ blocks until no write of tree (or of any tree if tree is None)
+        is pending or ongoing """
+        with self._condition:
+            while True:
+                if tree is None:
+                    busy = len(self._pending) > 0 or self._busy is not None
+                else:
+                    busy = id(tree) in self._pending or self._busy is tree
+                if not busy:
+                    return
+                self._condition.wait()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+                _, (tree, data, generation) = self._pending.popitem(
+                    last=False)
+                self._busy = tree
+            try:
+                tree._write_data(data, generation)
+            except BaseException as e:
+                logger.error("Error in background writing of config file "
+                             "%s: %s", tree._filename, e)
+            finally:
+                with self._condition:
+                    self._busy = None
+                    self._condition.notify_all()
+
+
+# the writer thread is only started once it is needed
+_config_writer = None
+_config_writer_lock = threading.Lock()
+
+
+def get_config_writer():
+    """ returns the (unique) ConfigWriter thread """
+    global _config_writer
+    with _config_writer_lock:
+        if _config_writer is None:
+            _config_writer = ConfigWriter()
+            _config_writer.start()
+        return _config_writer
+
+
+# all MemoryTree objects that must be flushed at interpreter shutdown
+_trees = weakref.WeakSet()
+
+
+@atexit.register
+def flush_all():
+    """ writes all pending changes of all MemoryTrees to disc """
+    for tree in list(_trees):
+        try:
+            tree._flush()
+        except BaseException as e:
+            logger.error("Could not flush config file %s: %s",
+                         tree._filename, e)
+
+
 # two functions to locate config files
 def _get_filename(filename=None):
     """ finds the correct path and name of a config file """
@@ -254,6 +433,8 @@ class MemoryBranch(object):
         if isinstance(self._data, list):
             raise NotImplementedError
         self._data.update(new_dict)
+        for k in new_dict:
+            self._mark_dirty(k)
         self._save()
         # keep auto_completion up to date
         for k in new_dict:
@@ -298,9 +479,31 @@ class MemoryBranch(object):
         creates a new entry, overriding the protection provided by dot notation
         if the value of this entry is of type dict, it becomes a MemoryBranch
         new values can be added to the branch in the same manner
+
+        Assigning a value that equals the existing one has no effect, and
+        a subbranch with the same keys is updated entry by entry instead of
+        being rebuilt, such that only actually changed values cause saves.
         """
+        try:
+            old = self._data[item]
+        except (KeyError, IndexError, TypeError):
+            old = None
+        else:
+            if equal(old, value):
+                self._root._skipped_save_counter += 1
+                return
         # if the subbranch is set or replaced, to this in a specific way
-        if isbranch(value):
+        if isinstance(old, dict) and isinstance(value, dict) and \
+                list(old.keys()) == list(value.keys()) or \
+                isinstance(old, list) and isinstance(value, list) and \
+                len(old) == len(value):
+            # the children save themselves if they change
+            subbranch = self[item]
+            for k, v in (value.items() if isinstance(value, dict)
+                         else enumerate(value)):
+                subbranch[k] = v
+            return
+        elif isbranch(value):
             # naive way: self._data[item] = dict(value)
             # rather: replace values in their natural order (e.g. if value is OrderedDict)
             # make an empty subbranch
@@ -320,6 +523,7 @@ class MemoryBranch(object):
         #otherwise just write to the data dictionary
         else:
             self._set_data(item, value)
+        self._mark_dirty(item)
         if self._root._WARNING_ON_SAVE or self._root._ERROR_ON_SAVE:
             logger.warning("Issuing call to MemoryTree._save after %s.%s=%s",
                            self._branch, item, value)
@@ -338,6 +542,16 @@ class MemoryBranch(object):
             # and we can simply set the entry
             self._data[item] = value
 
+    def _mark_dirty(self, item):
+        """
+        registers the path of item as changed since the last write to file
+        """
+        root = self._root
+        if self is root:
+            root._dirty_paths.add(str(item))
+        else:
+            root._dirty_paths.add(self._fullbranchname + '.' + str(item))
+
     def _pop(self, name):
         """
         remove an item from the branch
@@ -345,6 +559,7 @@ class MemoryBranch(object):
         value = self._data.pop(name)
         if name in self.__dict__.keys():
             self.__dict__.pop(name)
+        self._mark_dirty(name)
         self._save()
         return value
 
@@ -399,9 +614,9 @@ class MemoryBranch(object):
     @property
     def _fullbranchname(self):
         parent = self._parent
-        branchname = self._branch
+        branchname = str(self._branch)
         while parent != parent._parent:
-            branchname = parent._branch + '.' + branchname
+            branchname = str(parent._branch) + '.' + branchname
             parent = parent._parent
         return branchname
 
@@ -426,6 +641,7 @@ class MemoryBranch(object):
         """
         branch = load(yml_content)
         self._parent._data[self._branch] = branch
+        self._parent._mark_dirty(self._branch)
         self._save()
 
     def __len__(self):
@@ -478,8 +694,31 @@ class MemoryTree(MemoryBranch):
     # the internal memory of the last modifiation time by pyrpl. If the two
     # don't match, the file was altered outside the scope of pyrpl and _load
     # is called to reload it.
+    # 4. with _watch_file=True, a QFileSystemWatcher (based on inotify on
+    # linux, on polling where no such mechanism exists) notifies the tree of
+    # changes of the config file. _reload then never touches the file
+    # system, and the tree is reloaded in the event loop _WATCH_DELAY_MS
+    # after any external modification of the file.
 
     ##### internal save logic:
+    # 1. any change of the tree calls _save(), which immediately schedules
+    # a write with _write_to_file_async if the last write is older than
+    # _loadsavedeadtime. Otherwise, _savetimer is started to schedule the
+    # write once the deadtime has elapsed.
+    # 2. _write_to_file_async hands a snapshot of the data to the
+    # ConfigWriter thread, such that the event loop is never blocked by yml
+    # serialization and disc access. Several snapshots of the same tree
+    # waiting in the queue are coalesced into one write. Only explicit calls
+    # of _write_to_file write the file synchronously.
+    # 3. _flush blocks until all pending changes are on the disc. Code that
+    # needs the file to be up to date (e.g. before another tree reads it)
+    # must call it. It is called for all trees at interpreter shutdown.
+    # 4. _file_lock guarantees that the file and _mtime are never accessed
+    # by the main thread while the writer thread is working on them.
+    # 5. each write gets a generation number. _write_data ignores data that
+    # is older than the last written generation, such that a snapshot
+    # popped by the writer thread cannot overwrite a more recent
+    # synchronous write.
 
     # this structure will hold the data. Must define it here as immutable
     # to overwrite the property _data of MemoryBranch
@@ -490,11 +729,20 @@ class MemoryTree(MemoryBranch):
     _ERROR_ON_SAVE = False # Set this flag to true to raise
         # Exceptions upon save
 
-    def __init__(self, filename=None, source=None, _loadsavedeadtime=3.0):
+    _WATCH_DELAY_MS = 20  # delay between a file change notification and
+    # the reload, such that several consecutive changes trigger one reload
+
+    _watcher = None  # QFileSystemWatcher if _watch_file is True
+
+    def __init__(self, filename=None, source=None, _loadsavedeadtime=3.0,
+                 _watch_file=False):
         # never reload or save more frequently than _loadsavedeadtime because
         # this is the principal cause of slowing down the code (typ. 30-200 ms)
         # for immediate saving, call _save_now, for immediate loading _load_now
         self._loadsavedeadtime = _loadsavedeadtime
+        self._file_lock = threading.RLock()
+        self._generation = 0  # incremented for each write
+        self._written_generation = 0  # generation of the file on disc
         # first, make sure filename exists
         self._filename = get_config_file(filename, source)
         if filename is None:
@@ -503,18 +751,69 @@ class MemoryTree(MemoryBranch):
             self._data = OrderedDict()
         self._lastsave = time()
         # create a timer to postpone to frequent savings
-        self._savetimer = QtCore.QTimer()
-        self._savetimer.setInterval(self._loadsavedeadtime*1000)
+        self._savetimer = MainThreadTimer(int(self._loadsavedeadtime*1000))
         self._savetimer.setSingleShot(True)
-        self._savetimer.timeout.connect(self._write_to_file)
+        self._savetimer.timeout.connect(self._write_to_file_async)
         self._load()
 
         self._save_counter = 0 # cntr for unittest and debug purposes
         self._write_to_file_counter = 0  # cntr for unittest and debug purposes
+        self._skipped_save_counter = 0  # assignments of unchanged values
+        self._creation_time = time()
+        # full paths of the entries changed since the last write to file
+        self._dirty_paths = set()
 
         # root of the tree is also a MemoryBranch with parent self and
         # branch name ""
         super(MemoryTree, self).__init__(self, "")
+        if self._filename is not None:
+            _trees.add(self)
+            if _watch_file:
+                self._watch()
+
+    def _watch(self):
+        """
+        starts watching the config file for external changes
+        """
+        self._reloadtimer = MainThreadTimer(self._WATCH_DELAY_MS)
+        self._reloadtimer.timeout.connect(self._reload_if_changed)
+        if LOOP_BACKEND != 'qt':  # QFileSystemWatcher needs the Qt loop
+            logger.warning("Config file watching is not available with the "
+                           "%s loop backend. Falling back to periodic checks "
+                           "of its modification time.", LOOP_BACKEND)
+            return
+        watcher = QtCore.QFileSystemWatcher()
+        if not watcher.addPath(self._filename):
+            logger.warning("Could not watch config file %s. Falling back to "
+                           "periodic checks of its modification time.",
+                           self._filename)
+            return
+        watcher.fileChanged.connect(self._file_changed)
+        self._watcher = watcher
+
+    def _file_changed(self, path):
+        """ slot for the fileChanged signal of _watcher """
+        # the atomic write (file replaced by another one) removes the file
+        # from the watcher
+        if path not in self._watcher.files() and os.path.isfile(path):
+            self._watcher.addPath(path)
+        self._reloadtimer.start()
+
+    def _reload_if_changed(self):
+        """ reloads the file if it was not written by this tree """
+        with self._file_lock:
+            try:
+                mtime = os.path.getmtime(self._filename)
+            except OSError:  # file is being replaced by another process
+                self._reloadtimer.start()
+                return
+            if self._watcher is not None and \
+                    self._filename not in self._watcher.files():
+                self._watcher.addPath(self._filename)
+            if mtime != self._mtime:
+                logger.debug("Config file %s was changed externally. "
+                             "Reloading...", self._filename)
+                self._load()
 
     @property
     def _buffer_filename(self):
@@ -527,11 +826,11 @@ class MemoryTree(MemoryBranch):
             # if no file is used, just ignore this call
             return
         logger.debug("Loading config file %s", self._filename)
-        # read file from disc
-        with open(self._filename) as f:
-            self._data = load(f)
-        # store the modification time of this file version
-        self._mtime = os.path.getmtime(self._filename)
+        with self._file_lock:
+            # read file from disc
+            self._data = load_file(self._filename)
+            # store the modification time of this file version
+            self._mtime = os.path.getmtime(self._filename)
         # make sure that reload timeout starts from this moment
         self._lastreload = time()
         # empty file gives _data=None
@@ -555,17 +854,21 @@ class MemoryTree(MemoryBranch):
         # first check if a reload was not performed recently (speed up reasons)
         if self._filename is None:
             return
+        # the file watcher takes care of reloading
+        if self._watcher is not None:
+            return
         # check whether reload timeout has expired
         if time() > self._lastreload + self._loadsavedeadtime:
             # prepare next timeout
             self._lastreload = time()
             logger.debug("Checking change time of config file...")
-            if self._mtime != os.path.getmtime(self._filename):
-                logger.debug("Loading because mtime %s != filetime %s",
-                             self._mtime)
-                self._load()
-            else:
-                logger.debug("... no reloading required")
+            with self._file_lock:
+                if self._mtime != os.path.getmtime(self._filename):
+                    logger.debug("Loading because mtime %s != filetime %s",
+                                 self._mtime)
+                    self._load()
+                else:
+                    logger.debug("... no reloading required")
 
     def _write_to_file(self):
         """
@@ -576,11 +879,46 @@ class MemoryTree(MemoryBranch):
             self._savetimer.stop()
         self._lastsave = time()
         self._write_to_file_counter += 1
-        logger.debug("Saving config file %s", self._filename)
+        logger.debug("Saving config file %s (changed: %s)", self._filename,
+                     sorted(self._dirty_paths))
+        self._dirty_paths = set()
         if self._filename is None:
             # skip writing to file if no filename was selected
             return
-        else:
+        # an older snapshot waiting in the queue is obsolete now
+        if _config_writer is not None:
+            _config_writer.discard(self)
+        self._generation += 1
+        self._write_data(self._data, self._generation)
+
+    def _write_to_file_async(self):
+        """
+        Writes a snapshot of the memory tree to file in the background
+        """
+        if self._savetimer.isActive():
+            self._savetimer.stop()
+        self._lastsave = time()
+        self._write_to_file_counter += 1
+        logger.debug("Scheduling save of config file %s (changed: %s)",
+                     self._filename, sorted(self._dirty_paths))
+        self._dirty_paths = set()
+        if self._filename is None:
+            return
+        self._generation += 1
+        get_config_writer().submit(self, snapshot(self._data),
+                                   self._generation)
+
+    def _write_data(self, data, generation):
+        """
+        Writes data of the given generation to the config file, unless a
+        more recent generation has already been written. This function may
+        be called from the ConfigWriter thread.
+        """
+        with self._file_lock:
+            if generation <= self._written_generation:
+                logger.debug("Skipping obsolete write of config file %s.",
+                             self._filename)
+                return
             if self._mtime != os.path.getmtime(self._filename):
                 logger.warning("Config file has recently been changed on your " +
                                "harddisk. These changes might have been " +
@@ -593,7 +931,7 @@ class MemoryTree(MemoryBranch):
             # http://stackoverflow.com/questions/2333872/atomic-writing-to-file-with-python:
             try:
                 f = open(self._buffer_filename, mode='w')
-                save(self._data, stream=f)
+                save(data, stream=f)
                 f.flush()
                 os.fsync(f.fileno())
                 f.close()
@@ -605,13 +943,26 @@ class MemoryTree(MemoryBranch):
                 raise
             # save last modification time of the file
             self._mtime = os.path.getmtime(self._filename)
+            self._written_generation = generation
+
+    def _flush(self):
+        """
+        Blocks until all changes of the memory tree have been written to file
+        """
+        if self._savetimer.isActive():
+            self._write_to_file_async()
+        if _config_writer is not None:
+            _config_writer.wait(self)
 
     def _save(self, deadtime=None):
         """
         A call to this function means that the state of the tree has changed
         and needs to be saved eventually. To reduce system load, the delay
         between two writes will be at least deadtime (defaults to
-        self._loadsavedeadtime if None)
+        self._loadsavedeadtime if None). If the last write is older than
+        deadtime, the write is scheduled immediately, otherwise it is
+        postponed. The file is always written in the background by the
+        ConfigWriter thread, use _flush() to wait for the write.
         """
         if self._ERROR_ON_SAVE:
             raise UnexpectedSaveError("Save to config file should not "
@@ -624,12 +975,28 @@ class MemoryTree(MemoryBranch):
             deadtime = self._loadsavedeadtime
         # now write current tree structure and data to file
         if self._lastsave + deadtime < time():
-            self._write_to_file()
+            self._write_to_file_async()
         else:
             # make sure saving will eventually occur by launching a timer
             if not self._savetimer.isActive():
                 self._savetimer.start()
 
+    @property
+    def _save_stats(self):
+        """
+        returns a dict with the number of calls to _save, of writes to file
+        and of skipped assignments of unchanged values, together with the
+        corresponding rates (per second) since the creation of the tree
+        """
+        duration = max(time() - self._creation_time, 1e-9)
+        stats = OrderedDict([('saves', self._save_counter),
+                             ('writes', self._write_to_file_counter),
+                             ('skipped', self._skipped_save_counter)])
+        for k, v in list(stats.items()):
+            stats[k + '_per_s'] = v / duration
+        stats['dirty_paths'] = sorted(self._dirty_paths)
+        return stats
+
     @property
     def _filename_stripped(self):
         try:
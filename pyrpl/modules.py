@@ -560,10 +560,14 @@ class Module(with_metaclass(ModuleMetaClass, object)):
         :param  y_values: numpy array with y values
         :param  attributes: extra curve parameters (such as relevant module
         settings)
+
+        The curve is written in a background thread, such that acquisitions
+        are not delayed. curve.saved is a Future that completes when the
+        curve is written.
         """
-        curve = CurveDB.create(x_values,
-                               y_values,
-                               **attributes)
+        curve = CurveDB.create_async(x_values,
+                                     y_values,
+                                     **attributes)
         return curve
 
     def free(self):
@@ -725,9 +729,19 @@ class HardwareModule(Module):
     def _reads(self, addr, length):
         return self._client.reads(self._addr_base + addr, length)
 
+    def _reads_batch(self, requests):
+        """ reads several (addr, length) ranges in one batched transfer """
+        return self._client.reads_batch([(self._addr_base + addr, length)
+                                         for addr, length in requests])
+
     def _writes(self, addr, values):
         self._client.writes(self._addr_base + addr, values)
 
+    def _writes_batch(self, requests):
+        """ writes several (addr, values) ranges in one batched transfer """
+        self._client.writes_batch([(self._addr_base + addr, values)
+                                   for addr, values in requests])
+
     def _read(self, addr):
         return int(self._reads(addr, 1)[0])
 
@@ -163,7 +163,7 @@ from .software_modules import lockbox
 from .software_modules.lockbox import models
 #from .software_modules.lockbox.models import *  # make sure all models are
 # loaded when we get started
-from . import user_config_dir
+from . import user_config_dir, LOOP_BACKEND
 
 # input is the wrong function in python 2
 try:
@@ -219,6 +219,9 @@ class Pyrpl(object):
         self.logger = logging.getLogger(name='pyrpl') # default: __name__
         # use gui or commandline for questions?
         gui = 'gui' not in kwargs or kwargs['gui']
+        if LOOP_BACKEND != 'qt':  # no QApplication for widgets
+            gui = False
+            kwargs['gui'] = False
         # get config file if None is specified
         if config is None:
             if gui:
@@ -299,7 +302,7 @@ class Pyrpl(object):
                 #                       module.name, module.name, self.c._filename, e)
                 #     raise e
         # make the gui if applicable
-        if self.c.pyrpl.gui:
+        if self.c.pyrpl.gui and LOOP_BACKEND == 'qt':
             self.show_gui()
 
     def show_gui(self):
@@ -20,6 +20,7 @@
 import numpy as np
 import socket
 import logging
+import threading
 try:
     from pysine import sine  # for debugging read/write calls
 except:
@@ -53,6 +54,10 @@ class MonitorClient(object):
         self._port = port
         self._read_counter = 0 # For debugging and unittests
         self._write_counter = 0 # For debugging and unittests
+        if not hasattr(self, '_lock'):  # restart() calls __init__ again
+            # serializes transfers from different threads (e.g. the
+            # acquisition threads) on the socket
+            self._lock = threading.RLock()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # try to connect at least 5 times
         for i in range(5):
@@ -101,15 +106,50 @@ class MonitorClient(object):
         if hasattr(self, '_sound_debug') and self._sound_debug:
             sine(880, 0.05)
         return self.try_n_times(self._writes, addr, values)
+
+    def reads_batch(self, requests):
+        """
+        Reads several memory ranges in one batched transfer, i.e. all
+        requests are sent before the first answer is received.
+
+        requests: list of (addr, length) tuples
+        returns: list of arrays with the data of each request
+        """
+        self._read_counter += 1
+        addrs = [addr for addr, length in requests]
+        lengths = [length for addr, length in requests]
+        return self.try_n_times(self._reads_batch, addrs, lengths)
+
+    def writes_batch(self, requests):
+        """
+        Writes several memory ranges in one batched transfer, i.e. all
+        requests are sent before the first acknowledgement is received.
+
+        requests: list of (addr, values) tuples
+        """
+        self._write_counter += 1
+        addrs = [addr for addr, values in requests]
+        values = [values for addr, values in requests]
+        return self.try_n_times(self._writes_batch, addrs, values)
     
     # the actual code
+    @staticmethod
+    def _header(command, addr, length):
+        """ returns the 8 byte header of a read (command b'r') or write
+        (command b'w') of length values at addr """
+        return command + bytes(bytearray([0,
+                                          length & 0xFF,
+                                          (length >> 8) & 0xFF,
+                                          addr & 0xFF,
+                                          (addr >> 8) & 0xFF,
+                                          (addr >> 16) & 0xFF,
+                                          (addr >> 24) & 0xFF]))
+
     def _reads(self, addr, length):
         if length > 65535:
             length = 65535
             self.logger.warning("Maximum read-length is %d", length)
-        header = b'r' + bytes(bytearray([0,
-                                         length & 0xFF, (length >> 8) & 0xFF,
-                                         addr & 0xFF, (addr >> 8) & 0xFF, (addr >> 16) & 0xFF, (addr >> 24) & 0xFF]))
+        header = self._header(b'r', addr, length)
         self.socket.send(header)
         data = self.socket.recv(length * 4 + 8)
         while (len(data) < length * 4 + 8):
@@ -121,16 +161,48 @@ class MonitorClient(object):
             self.emptybuffer()
             return None
 
+    def _reads_batch(self, addrs, lengths):
+        headers = []
+        for addr, length in zip(addrs, lengths):
+            if length > 65535:
+                raise ValueError("Maximum read-length is 65535")
+            headers.append(self._header(b'r', addr, length))
+        self.socket.send(b''.join(headers))
+        results = []
+        for header, length in zip(headers, lengths):
+            data = self.socket.recv(length * 4 + 8)
+            while (len(data) < length * 4 + 8):
+                data += self.socket.recv(length * 4 - len(data) + 8)
+            if data[:8] != header:  # check for in-sync transmission
+                self.logger.error("Wrong control sequence from server: %s",
+                                  data[:8])
+                self.emptybuffer()
+                return None
+            results.append(np.frombuffer(data[8:], dtype=np.uint32))
+        return results
+
+    def _writes_batch(self, addrs, values_list):
+        headers, messages = [], []
+        for addr, values in zip(addrs, values_list):
+            values = values[:65535 - 2]
+            header = self._header(b'w', addr, len(values))
+            headers.append(header)
+            messages.append(header +
+                            np.array(values, dtype=np.uint32).tobytes())
+        self.socket.send(b''.join(messages))
+        for header in headers:
+            answer = self.socket.recv(8)
+            while len(answer) < 8:
+                answer += self.socket.recv(8 - len(answer))
+            if answer != header:  # check for in-sync transmission
+                self.logger.error("Error: wrong control sequence from server")
+                self.emptybuffer()
+                return None
+        return True  # indicate successful write
+
     def _writes(self, addr, values):
         values = values[:65535 - 2]
-        length = len(values)
-        header = b'w' + bytes(bytearray([0,
-                                         length & 0xFF,
-                                         (length >> 8) & 0xFF,
-                                         addr & 0xFF,
-                                         (addr >> 8) & 0xFF,
-                                         (addr >> 16) & 0xFF,
-                                         (addr >> 24) & 0xFF]))
+        header = self._header(b'w', addr, len(values))
         # send header+body
         self.socket.send(header +
                          np.array(values, dtype=np.uint32).tobytes())
@@ -149,23 +221,26 @@ class MonitorClient(object):
             self.logger.debug("Read %d bytes from socket...", n)
 
     def try_n_times(self, function, addr, value, n=5):
-        for i in range(n):
-            try:
-                value = function(addr, value)
-            except (socket.timeout, socket.error):
-                self.logger.error("Error occured in reading attempt %s. "
-                                  "Reconnecting at addr %s to %s value %s by "
-                                  "client %s"
-                                  % (i,
-                                     hex(addr),
-                                     function.__name__,
-                                     value,
-                                     self.client_number))
-                if self._restartserver is not None:
-                    self.restart()
-            else:
-                if value is not None:
-                    return value
+        with self._lock:
+            for i in range(n):
+                try:
+                    value = function(addr, value)
+                except (socket.timeout, socket.error):
+                    self.logger.error("Error occured in reading attempt %s. "
+                                      "Reconnecting at addr %s to %s value %s by "
+                                      "client %s"
+                                      % (i,
+                                         [hex(a) for a in addr]
+                                         if isinstance(addr, list)
+                                         else hex(addr),
+                                         function.__name__,
+                                         value,
+                                         self.client_number))
+                    if self._restartserver is not None:
+                        self.restart()
+                else:
+                    if value is not None:
+                        return value
 
     def restart(self):
         self.close()
@@ -258,10 +333,17 @@ class DummyClient(object):  # pragma: no cover
         for i in range(length):
             val.append(self.read_fpgamemory(addr+0x4*i))
         return np.array(val, dtype=np.uint32)
+
+    def reads_batch(self, requests):
+        return [self.reads(addr, length) for addr, length in requests]
     
     def writes(self, addr, values): # pragma: no-cover
         for i, v in enumerate(values):
             self.fpgamemory[str(addr+0x4*i)]=v
+
+    def writes_batch(self, requests):
+        for addr, values in requests:
+            self.writes(addr, values)
     
     def restart(self):
         pass
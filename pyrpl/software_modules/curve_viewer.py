@@ -12,7 +12,7 @@ MAX_CURVES = 100  # maximum number of curves to display
 
 
 def all_curves(instance=None):
-    return CurveDB.all()[:MAX_CURVES]
+    return CurveDB.get(CurveDB.all_pks()[:MAX_CURVES])
 
 
 class CurveViewer(Module):
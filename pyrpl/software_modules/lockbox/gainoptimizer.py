@@ -1,6 +1,5 @@
-from qtpy import QtCore
 from pyrpl.software_modules.lockbox import *
-from pyrpl.async_utils import sleep
+from pyrpl.async_utils import sleep, MainThreadTimer
 
 
 class GainOptimizerLoop(LockboxPlotLoop):
@@ -102,7 +101,9 @@ class GainOptimizer(LockboxModule):
                 return self.start()
 
     def start_delayed(self):
-        QtCore.QTimer.singleShot(100, self._start_when_locked)
+        self._start_timer = MainThreadTimer(100)
+        self._start_timer.timeout.connect(self._start_when_locked)
+        self._start_timer.start()
 
     def stop(self):
         if hasattr(self, 'loop') and self.loop is not None:
@@ -132,6 +132,12 @@ class SpectrumAnalyzer(AcquisitionModule):
     The spectrum analyzer connections are made upon calling the function setup.
     """
     _widget_class = SpecAnWidget
+    # _get_curve() reads the scope buffers (_get_filtered_iq_data) and the
+    # attributes baseband, data_length, frequencies, window and the
+    # transfer_function() of the iq module and the scope, which the GUI can
+    # change during a run. It is therefore not called from an
+    # AcquisitionThread until these reads are made thread-safe.
+    _threaded_acquisition = False
     _gui_attributes = ["input",
                        "center",
                        "baseband",
@@ -476,8 +482,8 @@ class SpectrumAnalyzer(AcquisitionModule):
         :return:
         """
         iq_data = self._get_filtered_iq_data() # get iq data (from scope)
-        if not self.running_state in ["running_single", "running_continuous"]:
-            self.pyrpl.scopes.free(self.scope) # free scope if not continuous
+        # the scope is freed by the CurveFuture (with
+        # _free_up_resources) if not continuous
         if self.baseband:
             # In baseband, where the 2 real inputs are stored in the real and
             # imaginary part of iq_data, we need to make 2 different FFTs. Of
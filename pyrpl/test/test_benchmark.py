@@ -0,0 +1,49 @@
+import logging
+logger = logging.getLogger(name=__name__)
+import json
+import numpy as np
+from .test_base import TestPyrpl
+from ..benchmark import EmulatorServer, run_benchmarks
+from ..redpitaya_client import MonitorClient
+from ..async_utils import sleep, set_sleep_mode, SLEEP_MODES
+from timeit import default_timer
+
+
+class TestBenchmark(TestPyrpl):
+    def test_emulator(self):
+        server = EmulatorServer()
+        server.start()
+        client = MonitorClient('localhost', server.port)
+        try:
+            client.writes(0x40000000, [1, 2, 3])
+            assert (client.reads(0x40000000, 3) == [1, 2, 3]).all()
+            first, second = client.reads_batch([(0x40000000, 1),
+                                                (0x40000008, 1)])
+            assert first[0] == 1 and second[0] == 3
+        finally:
+            client.close()
+            server.stop()
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(pyrpl=self.pyrpl, repetitions=2)
+        json.dumps(results)  # must be serializable
+        for name in ['registers', 'setup', 'scope', 'scope_rolling',
+                     'spectrum_analyzer', 'network_analyzer', 'sleep']:
+            assert name in results['results']
+            assert 'error' not in results['results'][name], \
+                (name, results['results'][name])
+        read = results['results']['registers']['read']
+        assert read['rate'] > 0
+        assert read['latency_p50_ms'] <= read['latency_max_ms']
+
+    def test_sleep_modes(self):
+        for mode in SLEEP_MODES:
+            tic = default_timer()
+            sleep(0.005, mode=mode)
+            assert default_timer() - tic >= 0.005
+        try:
+            set_sleep_mode('unknown')
+        except ValueError:
+            pass
+        else:
+            assert False, "set_sleep_mode should not accept 'unknown'"
@@ -0,0 +1,339 @@
+import logging
+logger = logging.getLogger(name=__name__)
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+from ..curvedb import CurveDB, SqliteCurveDB, PayloadCache, payload_cache, \
+    flush_curves
+
+
+class TestSqliteCurveDB(object):
+    """ tests of the sqlite backend in a temporary directory """
+    def setup(self):
+        self.dirname = tempfile.mkdtemp()
+        self.old_dirname = SqliteCurveDB._dirname
+        SqliteCurveDB._dirname = self.dirname
+
+    def teardown(self):
+        SqliteCurveDB._dirname = self.old_dirname
+        shutil.rmtree(self.dirname, ignore_errors=True)
+
+    def test_create_get_delete(self):
+        t0 = time.time()
+        c = SqliteCurveDB.create(np.arange(5), np.arange(5) * 2.,
+                                 name='parent', foo=1, bar=np.float64(2.5))
+        child = SqliteCurveDB.create(np.arange(3), np.arange(3) * 1j,
+                                     name='child', foo=2)
+        c.add_child(child)
+        assert SqliteCurveDB.all_pks() == [child.pk, c.pk]
+        c2 = SqliteCurveDB.get(c.pk)
+        assert c2.name == 'parent'
+        assert c2.params['bar'] == 2.5
+        assert (c2.data[1] == c.data[1]).all()
+        assert [ch.pk for ch in c2.childs] == [child.pk]
+        assert c2.get_child('child').data[1].dtype == np.complex128
+        assert SqliteCurveDB.get(child.pk).parent.pk == c.pk
+        # queries
+        assert SqliteCurveDB.query(name='parent') == [c.pk]
+        assert SqliteCurveDB.query(name='*a*') == [c.pk]
+        assert SqliteCurveDB.query(foo=2) == [child.pk]
+        assert SqliteCurveDB.query(parent=c.pk) == [child.pk]
+        assert SqliteCurveDB.query(created_after=t0) == [child.pk, c.pk]
+        assert SqliteCurveDB.query(created_before=t0) == []
+        # deleting the parent deletes the child
+        c2.delete()
+        assert SqliteCurveDB.all_pks() == []
+
+    def test_create_async(self):
+        """ the index is written by the CurveSaver thread, and the data are
+        only marked as saved once the write succeeded """
+        save_params = SqliteCurveDB.__dict__['_save_params']
+        threads = []
+
+        def failing_save_params(curve):
+            threads.append(threading.current_thread())
+            raise IOError("disc full")
+        SqliteCurveDB._save_params = failing_save_params
+        try:
+            c = SqliteCurveDB.create_async(np.arange(5.), np.arange(5.),
+                                           name='async')
+            try:
+                c.saved.result(timeout=5)
+            except IOError:
+                pass
+            else:
+                assert False, "the save should have failed"
+        finally:
+            SqliteCurveDB._save_params = save_params
+        assert threads[0] is not threading.current_thread()
+        assert not c._data_saved
+        assert SqliteCurveDB.all_pks() == []
+        assert c.save_async().result(timeout=5) == c.pk
+        assert c._data_saved
+        assert SqliteCurveDB.all_pks() == [c.pk]
+        assert SqliteCurveDB.query(name='async') == [c.pk]
+        assert (SqliteCurveDB.get(c.pk).data[1] == np.arange(5.)).all()
+
+
+class TestCurveDB(object):
+    """ tests of the default file backend in a temporary directory """
+    def setup(self):
+        self.dirname = tempfile.mkdtemp()
+        self.old_dirname = CurveDB._dirname
+        CurveDB._dirname = self.dirname
+
+    def teardown(self):
+        CurveDB._dirname = self.old_dirname
+        shutil.rmtree(self.dirname, ignore_errors=True)
+
+    def files(self):
+        """ curve files in the directory, without the pk counter """
+        return sorted(f for f in os.listdir(self.dirname)
+                      if not f.startswith('.'))
+
+    def test_binary_format(self):
+        c = CurveDB.create(np.arange(4.), np.arange(4) * 1j, name='curve')
+        assert self.files() == \
+            ['%d%s' % (c.pk, ext) for ext in ['.params', '.x.npy', '.y.npy']]
+        c2 = CurveDB.get(c.pk)
+        assert c2.name == 'curve'
+        assert (c2.data[1] == np.arange(4) * 1j).all()
+        # loaded data are read-only, modified data must be assigned
+        try:
+            c2.data[1][0] = 1
+        except ValueError:
+            pass
+        else:
+            assert False, "loaded data should be read-only"
+        c2.data = (c2.data[0], c2.data[1] + 1)
+        c2.save()
+        assert CurveDB.get(c.pk).data[1][0] == 1
+        c2.delete()
+        assert self.files() == []
+
+    def test_migrate(self):
+        with open(os.path.join(self.dirname, '7.dat'), 'wb') as f:
+            pickle.dump([7, {'name': 'old', 'childs': None},
+                         [[1., 2.], [3., 4.]]], f)
+        assert CurveDB.all_pks() == [7]
+        assert CurveDB.get(7).data[1][1] == 4.
+        assert CurveDB.migrate() == [7]
+        assert not os.path.exists(os.path.join(self.dirname, '7.dat'))
+        c = CurveDB.get(7)
+        assert c.name == 'old'
+        assert (c.data[0] == [1., 2.]).all()
+
+    def test_pk_allocation(self):
+        # the counter is initialized from existing curves
+        with open(os.path.join(self.dirname, '7.dat'), 'wb') as f:
+            pickle.dump([7, {'name': 'old', 'childs': None}, [[], []]], f)
+        c = CurveDB.create([1], [2], name='a')
+        assert c.pk == 8
+        # curves that appear in the directory are skipped
+        open(os.path.join(self.dirname, '9.params'), 'w').close()
+        assert CurveDB.create([1], [2], name='b').pk == 10
+        # simultaneous allocations yield unique pks
+        pks = []
+        def allocate():
+            for i in range(20):
+                pks.append(CurveDB._next_pk())
+        threads = [threading.Thread(target=allocate) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(pks) == list(range(11, 91))
+        # a lock file left over by a crashed process is broken once
+        lock = os.path.join(self.dirname, '.pk_counter.lock')
+        open(lock, 'w').close()
+        os.utime(lock, (time.time() - 100, time.time() - 100))
+        pks = []
+        threads = [threading.Thread(target=allocate) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(pks) == list(range(91, 171))
+        assert not any(f.startswith('.pk_counter.lock')
+                       for f in os.listdir(self.dirname))
+
+    def test_lazy_loading(self):
+        c = CurveDB.create(np.arange(10.), np.arange(10.), name='parent')
+        c.add_child(CurveDB.create([1.], [2.], name='child'))
+        payload_cache.clear()
+        c2 = CurveDB.get(c.pk)
+        assert c2._data is None
+        # hierarchy traversal only loads params
+        child = c2.get_child('child')
+        assert child._data is None
+        assert child.data[1][0] == 2.
+        # data are cached
+        assert CurveDB.get(child.pk).data is child.data
+        # the cache entry is replaced when the curve is saved with new data
+        child.data = ([1.], [3.])
+        child.save()
+        assert CurveDB.get(child.pk).data[1][0] == 3.
+        # size limit of the cache
+        cache = PayloadCache(max_bytes=100, max_items=2)
+        cache.put(1, (np.zeros(5), np.zeros(5)))
+        cache.put(2, (np.zeros(1), np.zeros(1)))
+        assert cache.get(1) is not None
+        cache.put(3, (np.zeros(1), np.zeros(1)))
+        assert cache.get(2) is None
+        cache.put(4, (np.zeros(100), np.zeros(100)))
+        assert cache.get(4) is None
+
+    def test_save_async(self):
+        x = np.arange(10.)
+        c = CurveDB.create_async(x, x, name='parent')
+        pk = c.pk
+        x[:] = 0  # modifications after submission are not saved
+        child = CurveDB.create_async([1.], [2.], name='child')
+        c.add_child(child)
+        assert c.saved.result(timeout=5) == pk
+        flush_curves()
+        assert not c.saving
+        c2 = CurveDB.get(pk)
+        assert c2.params['childs'] == [child.pk]
+        assert c2.data[1][1] == 1.
+        assert c2.childs[0].params['parent'] == pk
+        assert 'autosave' not in c2.params
+
+    def test_append(self):
+        c = CurveDB.create(name='log')
+        c.append_chunk_size = 10
+        for i in range(5):
+            c.append(np.arange(10.) + 10 * i, np.ones(10) * i)
+        assert len(c.chunks) == 5
+        assert len(c.data[0]) == 50
+        c2 = CurveDB.get(c.pk)
+        x, y = c2.data_range(15, 24.5)
+        assert c2._data is None  # only the overlapping chunks were loaded
+        assert list(x) == list(range(15, 25))
+        assert list(y) == [1] * 5 + [2] * 5
+        # a curve with data is converted to chunks
+        c3 = CurveDB.create([0., 1.], [2., 3.], name='log')
+        c3.append(2., 4.)
+        assert CurveDB.get(c3.pk).chunks == [[2, 0., 1., 0]]
+        c3.flush()
+        assert list(CurveDB.get(c3.pk).data[1]) == [2., 3., 4.]
+        # assigning new data removes the chunks
+        c3.data = ([0.], [1.])
+        c3.save()
+        assert CurveDB.get(c3.pk).chunks is None
+        assert not any('.chunk' in f for f in self.files()
+                       if f.startswith('%s.' % c3.pk))
+        c.delete()
+        assert not any(f.startswith('%s.' % c.pk) for f in self.files())
+        # small appends are buffered and merged into the last chunk
+        c4 = CurveDB.create(name='log')
+        c4.append_interval = 0  # write every point
+        for i in range(100):
+            c4.append(i, i)
+        assert len(c4.chunks) == 1
+        assert len([f for f in self.files() if '.chunk' in f]) == 2
+        c4.append_interval = 100
+        c4.append(100, 100)  # written at exit or before the next read
+        flush_curves()
+        assert list(CurveDB.get(c4.pk).data[1]) == list(range(101))
+        c4.delete()
+        # appends in the saver thread
+        c5 = CurveDB.create(name='log')
+        for i in range(3):
+            c5.append_async([i], [i])
+        assert c5.append_async([], [], flush=True).result() == c5.pk
+        assert list(CurveDB.get(c5.pk).data[1]) == [0, 1, 2]
+        c5.delete()
+
+    def test_pyramid(self):
+        n = 200000
+        x = np.linspace(0, 1, n)
+        y = np.zeros(n)
+        y[12345] = 1.  # a single peak must survive decimation
+        c = CurveDB.create(x, y, name='long')
+        assert len(c._pyramid_levels()) >= 2
+        c2 = CurveDB.get(c.pk)
+        xr, yr = c2.get_range(max_points=1000)
+        assert len(xr) <= 1002
+        assert yr.max() == 1.
+        # zooming in returns the full resolution
+        xr, yr = c2.get_range(x[12000], x[12999], max_points=1000)
+        assert len(xr) == 1000
+        assert yr[345] == 1.
+        # intermediate zoom
+        xr, yr = c2.get_range(0.05, 0.1, max_points=3000)
+        assert 1000 < len(xr) <= 3002
+        assert xr[0] <= 0.05 and xr[-1] <= 0.1
+        assert yr.max() == 1.
+        # short curves are decimated on the fly
+        c3 = CurveDB.create(np.arange(100.), np.arange(100.), name='short')
+        assert len(c3._pyramid_levels()) == 0
+        assert len(c3.get_range(max_points=10)[0]) <= 12
+        c.delete()
+        assert not any(f.startswith('%s.' % c.pk) for f in self.files())
+        # appended chunks have their own levels
+        c4 = CurveDB.create(name='log')
+        for i in range(4):
+            c4.append(x + i, y)
+        assert all(chunk[3] >= 2 for chunk in c4.chunks)
+        c5 = CurveDB.get(c4.pk)
+        xr, yr = c5.get_range(max_points=1000)
+        assert c5._data is None  # the chunks were not loaded
+        assert len(xr) <= 1002
+        assert yr.max() == 1.
+        xr, yr = c5.get_range(1.5, 2.5, max_points=3000)
+        assert c5._data is None
+        assert 1000 < len(xr) <= 3002
+        assert xr[0] <= 1.5 and xr[-1] <= 2.5
+        # zooming in returns the full resolution
+        xr, yr = c5.get_range(1.5, 1.502, max_points=1000)
+        assert len(xr) == len(c5.data_range(1.5, 1.502)[0]) > 300
+        c4.delete()
+        assert not any(f.startswith('%s.' % c4.pk) for f in self.files())
+        # short chunks, or all chunks without pyramid_threshold, get none
+        c6 = CurveDB.create(name='log')
+        c6.append(np.arange(1000.), np.arange(1000.))
+        c6.flush()
+        assert c6.chunks == [[1000, 0., 999., 0]]
+        c6.pyramid_threshold = None
+        c6.append(x + 1000, y)
+        assert [chunk[3] for chunk in c6.chunks] == [0]
+        assert c6.chunks[0][0] == 1000 + n
+        assert not any('.level' in f for f in self.files())
+        c6.delete()
+
+    def test_query_export(self):
+        t0 = time.time() - 1
+        c1 = CurveDB.create(np.arange(5.), np.arange(5.), name='na_1', foo=1)
+        c2 = CurveDB.create(np.arange(5.), np.arange(5.) * 1j, name='na_2')
+        c3 = CurveDB.create(np.arange(3.), np.arange(3.), name='scope',
+                            foo=1)
+        c1.add_child(c3)
+        assert CurveDB.query(name='na_*') == [c2.pk, c1.pk]
+        assert CurveDB.query(foo=1) == [c3.pk, c1.pk]
+        assert CurveDB.query(name='na_*', foo=1) == [c1.pk]
+        assert CurveDB.query(parent=c1.pk) == [c3.pk]
+        assert CurveDB.query(created_after=t0) == [c3.pk, c2.pk, c1.pk]
+        assert CurveDB.query(created_before=t0) == []
+        # the creation time is stored in the params, not in the files
+        for filename in self.files():
+            if filename.startswith('%s.' % c1.pk):
+                os.utime(os.path.join(self.dirname, filename), (t0 - 10,) * 2)
+        assert CurveDB.query(created_before=t0) == []
+        c4 = CurveDB.create(np.arange(5.), np.arange(5.) + 1, name='na_3')
+        filename = os.path.join(self.dirname, 'export.npz')
+        CurveDB.export([c1.pk, c2, c3.pk, c4.pk], filename)
+        with np.load(filename) as f:
+            assert list(f['pks_0']) == [c1.pk, c4.pk]
+            assert f['y_0'].shape == (2, 5)
+            assert f['y_0'][1, 0] == 1.
+            assert list(f['pks_1']) == [c2.pk]
+            assert f['y_1'].dtype == np.complex128
+            assert list(f['pks_2']) == [c3.pk]
+            params = json.loads(str(f['params']))
+        assert params[str(c3.pk)]['parent'] == c1.pk
@@ -1,5 +1,6 @@
 import logging
 logger = logging.getLogger(name=__name__)
+import threading
 import time
 import numpy as np
 from pyrpl.async_utils import sleep as async_sleep
@@ -7,6 +8,7 @@ from qtpy import QtCore, QtWidgets
 from pyrpl.test.test_base import TestPyrpl
 from pyrpl import APP
 from pyrpl.curvedb import CurveDB
+from pyrpl.acquisition_module import TripleBuffer
 
 class TestScope(TestPyrpl):
     """
@@ -211,3 +213,320 @@ class TestScope(TestPyrpl):
             for j in range(2):
                 assert len(curves[i].data[j]) == self.pyrpl.rp.scope.data_length
         self.curves += curves  # makes sure teardown will delete the curves
+
+    def test_get_curve_single_transfer(self):
+        scope = self.pyrpl.rp.scope
+        scope.stop()
+        counter = getattr(scope._client, '_read_counter', None)
+        curve = scope._get_curve()
+        assert curve.shape == (2, scope.data_length)
+        assert (abs(curve) <= 1).all()
+        if counter is not None:  # only counted by MonitorClient
+            assert scope._client._read_counter == counter + 1
+
+    def test_stream(self):
+        scope = self.pyrpl.rp.scope
+        scope.setup(duration=0.5,
+                    ch1_active=True,
+                    ch2_active=False,
+                    running_state="stopped")
+        length, sampling_time = scope.data_length, scope.sampling_time
+        decimation = int(scope.decimation)
+        t0 = time.time()
+        fail, changed = [], []
+
+        def reads_batch(requests):
+            """ simulates a scope whose write pointer advances in real
+            time, where each sample holds its index modulo 4096 """
+            if fail:
+                raise IOError("connection lost")
+            written = int((time.time() - t0) / sampling_time)
+            results = []
+            for addr, size in requests:
+                if addr == 0x18:  # write pointer
+                    results.append([(written - 1) % length])
+                elif addr == 0x15C:  # 64 bit timestamp
+                    timestamp = written * decimation
+                    results.append([timestamp % 2 ** 32, timestamp >> 32])
+                elif addr == 0x14:
+                    results.append([decimation + len(changed)])
+                else:  # latest sample at each index of the buffer
+                    index = np.arange(size) + (addr % 0x10000) // 4
+                    sample = written - 1 - (written - 1 - index) % length
+                    results.append(list(sample % 4096))
+            return results
+        scope._reads_batch = reads_batch
+        try:
+            chunks = []
+            stream = scope.stream(callback=lambda times, datas: chunks.append(
+                (times, datas)), chunk_size=100)
+            async_sleep(0.5)
+            stream.stop()
+            self.curves += stream.curves
+            assert stream.error is None
+            assert stream.gaps == []
+            times = np.concatenate([t for t, d in chunks])
+            values = np.concatenate([d[0] for t, d in chunks]) * 2 ** 13
+            n = len(times)
+            assert n == stream.n_samples
+            assert n > 0.3 / sampling_time, n  # about 0.5 s of samples
+            # the samples are contiguous
+            assert np.allclose(np.diff(times), sampling_time)
+            assert (np.diff(np.round(values)) % 4096 == 1).all()
+            assert len(stream.curves) == 1
+            assert len(stream.curves[0].data[0]) == n
+            # an error stops the stream
+            stream = scope.stream(save=False)
+            fail.append(True)
+            async_sleep(0.3)
+            assert isinstance(stream.error, IOError)
+            assert not stream._timer.isActive()
+            # so does a change of the decimation
+            fail.pop()
+            stream = scope.stream(save=False)
+            changed.append(True)
+            async_sleep(0.3)
+            assert isinstance(stream.error, ValueError)
+            assert not stream._timer.isActive()
+        finally:
+            del scope._reads_batch
+
+    def test_acquire_segments(self):
+        scope = self.pyrpl.rp.scope
+        scope.setup(duration=0.001,
+                    trigger_source='immediately',
+                    running_state="stopped")
+        timestamps, datas = scope.acquire_segments(3, timeout=5.)
+        assert datas.shape == (3, 2, scope.data_length)
+        assert (np.diff(timestamps) >= 0).all()
+        assert (abs(datas) <= 1).all()
+        # without triggers, the default timeout ends the acquisition
+        read = scope._read
+        scope._read = lambda addr: 0b1 if addr == 0x0 else read(addr)
+        try:
+            start = time.time()
+            timestamps, datas = scope.acquire_segments(3,
+                                                       trigger_interval=0.1)
+            assert time.time() - start < 3.
+            assert len(timestamps) == 0 and len(datas) == 0
+        finally:
+            del scope._read
+
+    def test_data_type(self):
+        scope = self.pyrpl.rp.scope
+        scope.stop()
+        rawdata = np.arange(-5, 5, dtype=np.int16).reshape(2, 5)
+        out = scope._roll_into(rawdata, 2, np.empty((2, 5), dtype=np.float32),
+                               scale=scope.raw_scale)
+        assert (out == np.roll(rawdata, -2, axis=1) * scope.raw_scale).all()
+        scope.data_type = 'float32'
+        try:
+            assert scope.setup_attributes['data_type'] == 'float32'
+            assert scope._get_curve().dtype == np.float32
+        finally:
+            scope.data_type = 'float64'
+        raw, scale = scope.get_raw_curve()
+        assert raw.dtype == np.int16
+        assert raw.shape == (2, scope.data_length)
+        assert (abs(raw * scale) <= 1).all()
+
+    def test_averaging(self):
+        scope = self.pyrpl.rp.scope
+        scope.stop()
+        old = scope.trace_average, scope.average_mode, scope.compute_variance
+        curves = [np.random.normal(size=(2, 10)) for i in range(7)]
+        try:
+            scope.trace_average = 3
+            scope.compute_variance = True
+            for mode in ['exponential', 'moving_window']:
+                scope.average_mode = mode
+                future = scope._run_future_cls(scope, min_delay_ms=0)
+                for i, curve in enumerate(curves):
+                    future._add_curve(curve)
+                    if mode == 'moving_window' or i < 3:
+                        last = np.array(curves[max(0, i - 2):i + 1])
+                        assert np.allclose(future.data_avg, last.mean(axis=0))
+                        assert np.allclose(future.data_var, last.var(axis=0))
+        finally:
+            scope.trace_average, scope.average_mode, \
+                scope.compute_variance = old
+
+    def test_times_cache(self):
+        scope = self.pyrpl.rp.scope
+        scope.setup(duration=0.001, trigger_source='asg0', trigger_delay=0.,
+                    running_state='stopped')
+        times = scope.times
+        assert scope.times is times  # cached
+        assert not times.flags.writeable
+        scope.trigger_delay = 0.001
+        assert scope.times is not times
+        assert abs(scope.times[scope.data_length // 2] - 0.001) < 1e-9
+        scope.duration = 0.01
+        assert abs(scope.times[-1] + scope.sampling_time - scope.times[0]
+                   - scope.duration) < 1e-9
+
+    def test_threaded_acquisition(self):
+        scope = self.pyrpl.rp.scope
+        scope.setup(duration=0.001, trigger_source='immediately',
+                    trace_average=10, running_state='stopped')
+        assert scope._threaded_acquisition
+        curve = scope.single(timeout=5.)
+        assert curve.shape == (2, scope.data_length)
+        assert scope.current_avg == 10
+        assert scope._acquisition_thread.is_alive()
+        future = scope.curve_async()
+        scope.stop()  # a cancelled future must not be completed later
+        async_sleep(0.05)
+        assert future.cancelled()
+
+    def test_rearm_in_thread(self):
+        """ the acquisition thread only re-arms the trigger between the
+        curves of a run, _start_acquisition() stays in the main thread """
+        scope = self.pyrpl.rp.scope
+        scope.setup(duration=0.001, trigger_source='immediately',
+                    trace_average=10, running_state='stopped')
+        calls = []
+        start, rearm = scope._start_acquisition, scope._rearm_acquisition
+
+        def start_acquisition():
+            calls.append(('start', threading.current_thread()))
+            start()
+
+        def rearm_acquisition():
+            calls.append(('rearm', threading.current_thread()))
+            return rearm()
+        scope._start_acquisition = start_acquisition
+        scope._rearm_acquisition = rearm_acquisition
+        try:
+            scope.single(timeout=5.)
+        finally:
+            del scope._start_acquisition
+            del scope._rearm_acquisition
+        assert [name for name, thread in calls] == ['start'] + 9 * ['rearm']
+        assert calls[0][1] is threading.current_thread()
+        assert all(thread is scope._acquisition_thread
+                   for name, thread in calls[1:])
+        assert scope._autosave_active
+
+    def test_restart_during_fetch(self):
+        """ a curve that is being fetched while the run is paused and
+        restarted is discarded, and the restart waits for the fetch """
+        scope = self.pyrpl.rp.scope
+        scope.setup(duration=0.001, trigger_source='immediately',
+                    trace_average=3, running_state='stopped')
+        events = []
+        fetching, resume = threading.Event(), threading.Event()
+        start, get_curve = scope._start_acquisition, scope._get_curve
+
+        def start_acquisition():
+            events.append('start')
+            start()
+
+        def slow_get_curve(out=None):
+            events.append('fetch')
+            if not fetching.is_set():
+                fetching.set()
+                resume.wait(5.)
+            return get_curve(out=out)
+        scope._start_acquisition = start_acquisition
+        scope._get_curve = slow_get_curve
+        try:
+            scope.running_state = 'running_single'
+            run = scope._run_future
+            add_curve = run._add_curve
+
+            def record_add_curve(curve):
+                events.append('add')
+                add_curve(curve)
+            run._add_curve = record_add_curve
+            for i in range(500):  # the job starts the acquisition through
+                if fetching.is_set():  # the event loop
+                    break
+                async_sleep(0.01)
+            assert fetching.is_set()
+            run.pause()
+            run.start()
+            assert events == ['start', 'fetch']
+            resume.set()
+            run.await_result(timeout=5.)
+        finally:
+            resume.set()
+            del scope._start_acquisition
+            del scope._get_curve
+        assert events[:4] == ['start', 'fetch', 'start', 'fetch'], events
+        assert events.count('add') == 3
+
+    def test_get_curve_out(self):
+        """ the acquisition thread fetches all curves of a run into the
+        same array """
+        scope = self.pyrpl.rp.scope
+        scope.setup(duration=0.001, trigger_source='immediately',
+                    trace_average=5, running_state='stopped')
+        out = np.empty((2, scope.data_length))
+        assert scope._get_curve(out=out) is out
+        outs, curves = [], []
+        get_curve = scope._get_curve
+
+        def get_curve_out(out=None):
+            outs.append(out)
+            curves.append(get_curve(out=out))
+            return curves[-1]
+        scope._get_curve = get_curve_out
+        try:
+            scope.single(timeout=5.)
+        finally:
+            del scope._get_curve
+        assert len(curves) == 5
+        assert outs[0] is None
+        assert all(out is curves[0] for out in outs[1:])
+        assert all(curve is curves[0] for curve in curves)
+
+    def test_triple_buffer(self):
+        buffer = TripleBuffer(lambda: np.zeros(3))
+        buffer.back[:] = 1
+        buffer.publish()
+        reading = buffer.read()
+        assert (reading == 1).all()
+        for i in range(2, 5):  # the writer never touches the read slot
+            assert buffer.back is not reading
+            buffer.back[:] = i
+            buffer.publish()
+        assert (reading == 1).all()
+        assert (buffer.read() == 4).all()
+
+    def test_continuous_threaded(self):
+        scope = self.pyrpl.rp.scope
+        scope.setup(duration=0.001, trigger_source='immediately',
+                    trace_average=1, rolling_mode=False,
+                    running_state='stopped')
+        scope.continuous()
+        try:
+            async_sleep(0.3)
+            assert scope.data_avg is not None
+            assert scope.data_avg.shape == (2, scope.data_length)
+            first = scope.data_avg.copy()
+            async_sleep(0.3)
+            assert (scope.data_avg != first).any()  # new curves arrived
+        finally:
+            scope.stop()
+
+    def test_display_coalescing(self):
+        scope = self.pyrpl.rp.scope
+        scope.stop()
+        received = []
+
+        def update_point(index):  # not connected to the scope widget
+            received.append(index)
+        scope._signal_launcher.update_point.connect(update_point)
+        old = scope.max_display_rate
+        try:
+            scope.max_display_rate = 5.
+            async_sleep(0.3)  # last display is long ago
+            for i in range(100):
+                scope._emit_signal_by_name('update_point', i)
+            async_sleep(0.5)
+            assert 1 <= len(received) <= 4
+            assert received[-1] == 99  # latest wins
+        finally:
+            scope.max_display_rate = old
+            scope._signal_launcher.update_point.disconnect(update_point)
@@ -0,0 +1,85 @@
+import logging
+logger = logging.getLogger(name=__name__)
+import os
+import subprocess
+import sys
+
+# runs in a separate interpreter, since the backend is chosen at import time
+SCRIPT = """
+import os
+import threading
+from pyrpl import APP, LOOP_BACKEND, Pyrpl
+from pyrpl.async_utils import MainThreadTimer, PyrplFuture, sleep, \\
+    call_in_main_thread, TimeoutError
+from pyrpl.memory import MemoryTree
+from pyrpl.software_modules.loop import Loop
+assert APP is None and LOOP_BACKEND == 'asyncio'
+hits = []
+timer = MainThreadTimer(10)
+timer.timeout.connect(lambda: hits.append(1))
+timer.start()
+sleep(0.05)
+assert hits == [1]
+future = PyrplFuture()
+threading.Timer(0.01, call_in_main_thread,
+                args=(future.set_result, 42)).start()
+assert future.await_result(timeout=1.) == 42
+try:
+    PyrplFuture().await_result(timeout=0.01)
+except TimeoutError:
+    pass
+else:
+    raise AssertionError('no TimeoutError')
+# modules
+p = Pyrpl(config='nosetests_loop_backend', hostname='_FAKE_REDPITAYA_')
+scope = p.rp.scope
+scope.setup(duration=0.001, trigger_source='immediately', trace_average=1,
+            rolling_mode=False, running_state='stopped')
+# CurveFuture
+curve = scope.curve_async().await_result(timeout=1.)
+assert curve.shape == (2, scope.data_length)
+# scope Loop with asynchronous curves
+futures = []
+def acquire(*args):
+    if not futures or futures[-1].done():  # would cancel the pending curve
+        futures.append(scope.curve_async())
+loop = Loop(scope, name='backend_loop', interval=0.02,
+            loop_function=acquire)
+loop.interval = 0.0204  # rounded to integer milliseconds
+assert loop.interval == 0.02, loop.interval
+# NetworkAnalyzer points
+na = p.networkanalyzer
+na.sleeptimes = 0.  # the DummyClient only offers a ~1 Hz bandwidth
+na.setup(start_freq=1e5, stop_freq=2e5, points=2, rbw=1e5,
+         avg_per_point=1, trace_average=1, running_state='stopped')
+na_curve = na.single_async()
+# pid refresh timer
+ivals = []
+p.rp.pid0._signal_launcher.update_ival.connect(lambda: ivals.append(1))
+# MemoryTree deferred save
+tree = MemoryTree('nosetests_loop_backend_tree', _loadsavedeadtime=0.1)
+tree.a = 1
+tree.a = 2  # postponed by the save timer
+assert tree._savetimer.isActive()
+sleep(1.2)
+loop.pause_loop()
+assert loop.n >= 20, loop.n
+assert len([f for f in futures if f.done() and not f.cancelled()]) >= 5
+assert len(na_curve.await_result(timeout=10.)) == 2
+assert len(ivals) >= 1
+assert not tree._savetimer.isActive()
+tree._flush()
+assert MemoryTree('nosetests_loop_backend_tree').a == 2
+os.remove(tree._filename)
+print('ok')
+"""
+
+
+class TestLoopBackend(object):
+    def test_asyncio_backend(self):
+        if sys.version_info < (3,):
+            return  # the asyncio backend requires python 3
+        env = dict(os.environ, PYRPL_LOOP_BACKEND='asyncio')
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT],
+                                         env=env)
+        assert output.decode().strip().endswith('ok')
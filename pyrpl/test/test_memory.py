@@ -1,7 +1,8 @@
 import logging
 logger = logging.getLogger(name=__name__)
 import os
-from ..memory import MemoryTree, MemoryBranch
+from ..memory import MemoryTree, MemoryBranch, snapshot, load_file, \
+    get_config_writer
 from .. import *
 from ..async_utils import sleep
 
@@ -87,6 +88,7 @@ class TestMemory(object):
         assert m1._save_counter == 4
         m1._save(0)
         assert m1._save_counter == 5
+        get_config_writer().wait(m1)  # the write is done in the background
         m1.a = 2
         assert m1._save_counter == 6
         m2 = MemoryTree(filename, _loadsavedeadtime=T2)
@@ -111,6 +113,7 @@ class TestMemory(object):
         assert m2.a == 2, m2.a
         m2.a = 3
         assert m2.a == 3
+        m2._flush()
         # m1 has also done nothing for a long time, so it will attempt to reload instantaneously
         assert m1.a == 3
         assert m1._write_to_file_counter == old_save_to_file + 1
@@ -139,6 +142,8 @@ class TestMemory(object):
         assert m1._write_to_file_counter == 5
         m1.a = 2
         assert m1._write_to_file_counter == 6
+        # writes are done in the background, other trees see them after _flush
+        m1._flush()
         m2 = MemoryTree(filename, _loadsavedeadtime=T2)
         assert m1._write_to_file_counter == 6
         assert m2._loadsavedeadtime == T2
@@ -153,15 +158,127 @@ class TestMemory(object):
         assert m2.a == 2, m2.a
         m2.a = 3
         assert m2.a == 3
+        m2._flush()
         # m1 has also done nothing for a long time, so it will attempt to reload instantaneously
         assert m1.a == 3
         assert m1._write_to_file_counter == 6
         m1.c = 5
+        m1._flush()
         assert m2.c == 5
         m2.c = 6
+        m2._flush()
         m1.c = 7
+        m1._flush()
         assert m2.c == 7, m2.c
         # clean up
         m1._write_to_file()
         m2._write_to_file()
         os.remove(m1._filename)
+
+    def test_background_write(self):
+        """ writes that are postponed by the save timer are performed by the
+        ConfigWriter thread and can be forced with _flush """
+        filename = 'test5'
+        m1 = MemoryTree(filename, _loadsavedeadtime=0.2)
+        m1.a = 1
+        m1.b = {'b1': [1, 2]}
+        assert m1._savetimer.isActive()
+        m1._flush()
+        assert not m1._savetimer.isActive()
+        assert m1._write_to_file_counter == 1
+        m2 = MemoryTree(filename)
+        assert m2.a == 1
+        assert m2.b.b1[1] == 2
+        # after the deadtime, the write of a change is immediately scheduled
+        sleep(0.25)
+        m1.a = 2
+        assert not m1._savetimer.isActive()
+        assert m1._write_to_file_counter == 2
+        m1._flush()
+        m3 = MemoryTree(filename)
+        assert m3.a == 2, m3.a
+        # the snapshot is independent of later modifications
+        data = snapshot(m1._data)
+        m1.b.b1[0] = 3
+        assert data['b']['b1'][0] == 1
+        # an older snapshot (e.g. popped by the writer thread just before a
+        # synchronous write) must not overwrite a more recent write
+        generation = m1._generation
+        m1._write_to_file()
+        m1._write_data(data, generation)
+        m4 = MemoryTree(filename)
+        assert m4.b.b1[0] == 3, m4.b.b1[0]
+        os.remove(m1._filename)
+
+    def test_load_cache(self):
+        """ the parsed tree is cached next to the yml file and the cache
+        is invalidated when the file is modified """
+        filename = 'test6'
+        m1 = MemoryTree(filename, _loadsavedeadtime=0)
+        m1.a = {'b': [1, 2.5, 'c']}
+        m1._flush()
+        m2 = MemoryTree(filename)
+        assert os.path.isfile(m2._filename + '.cache')
+        assert load_file(m2._filename) == m1._data
+        m3 = MemoryTree(filename)
+        assert m3.a.b[1] == 2.5
+        # external modification of the file
+        with open(m1._filename, 'a') as f:
+            f.write("d: 4\n")
+        assert load_file(m1._filename)['d'] == 4
+        assert MemoryTree(filename).d == 4
+        os.remove(m1._filename)
+        os.remove(m1._filename + '.cache')
+
+    def test_watch_file(self):
+        """ a tree with _watch_file=True never checks the file modification
+        time upon reads, but reloads the file after external changes """
+        filename = 'test7'
+        m1 = MemoryTree(filename, _loadsavedeadtime=0, _watch_file=True)
+        m1.a = 1
+        m1._flush()
+        m2 = MemoryTree(filename, _loadsavedeadtime=0)
+        assert m2.a == 1
+        m2.a = 2
+        m2._flush()
+        # the change is only seen once the event loop has been running
+        sleep(0.1)
+        assert m1.a == 2, m1.a
+        # own writes do not trigger a reload and the file is still watched
+        m1.b = 3
+        sleep(0.1)
+        assert m1.b == 3
+        m2.c = 4
+        m2._flush()
+        sleep(0.1)
+        assert m1.c == 4
+        m1._write_to_file()
+        os.remove(m1._filename)
+
+    def test_unchanged_values(self):
+        """ assigning unchanged values must not trigger any save """
+        m = MemoryTree(None)
+        m.a = 1
+        m.b = {'b1': 1, 'b2': [0, {'c': 2.2}]}
+        assert m._save_counter == 7
+        m.a = 1
+        m.b = {'b1': 1, 'b2': [0, {'c': 2.2}]}
+        assert m._save_counter == 7
+        assert m._skipped_save_counter == 2
+        # a change of type is a change
+        m.a = True
+        assert m._save_counter == 8
+        # only the changed entry of a subbranch is saved
+        m.b = {'b1': 1, 'b2': [0, {'c': 3.3}]}
+        assert m._save_counter == 9
+        assert m.b.b2[1].c == 3.3
+        assert m._dirty_paths == {'a', 'b', 'b.b1', 'b.b2', 'b.b2.0',
+                                  'b.b2.1', 'b.b2.1.c'}
+        # removing a key rebuilds the branch
+        m.b = {'b2': 1}
+        assert list(m.b._keys()) == ['b2']
+        stats = m._save_stats
+        assert stats['saves'] == m._save_counter
+        assert stats['skipped'] == 4
+        m._write_to_file()
+        assert len(m._dirty_paths) == 0
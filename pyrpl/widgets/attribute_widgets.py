@@ -868,23 +868,39 @@ class DataAttributeWidget(PlotAttributeWidget):
 class CurveAttributeWidget(DataAttributeWidget):
     """
     Plots a curve (complex or real), with an id number as input.
+
+    Only up to max_points points of the curve are plotted. The displayed
+    data are updated with the appropriate resolution when the x-range of
+    the plot changes (see CurveDB.get_range).
     """
-    def get_xy_data(self, new_value):
+    max_points = 5000
+
+    def _make_widget(self):
+        super(CurveAttributeWidget, self)._make_widget()
+        self.plot_item.sigXRangeChanged.connect(self._update_range)
+
+    def get_xy_data(self, new_value, x0=None, x1=None):
         """ helper function to extract xy data from a curve object"""
         if new_value is None:
             return None, None, None
         try:
-            data = getattr(self.module, '_' + self.attribute_name + '_object').data
-            name = getattr(
-                self.module, '_' + self.attribute_name + '_object').params['name']
+            curve = getattr(self.module, '_' + self.attribute_name + '_object')
+            name = curve.params['name']
+            x, y = curve.get_range(x0, x1, max_points=self.max_points)
         except:
             return None, None, None
         else:
-            x, y = data
             return x, y, name
 
-    def _set_widget_value(self, new_value):
-        x, y, name = self.get_xy_data(new_value)
+    def _update_range(self, *args):
+        if self.plot_item.getViewBox().autoRangeEnabled()[0]:
+            return  # the full curve is displayed anyways
+        x0, x1 = self.plot_item.viewRange()[0]
+        self._set_widget_value(getattr(self.module, self.attribute_name),
+                               x0=x0, x1=x1)
+
+    def _set_widget_value(self, new_value, x0=None, x1=None):
+        x, y, name = self.get_xy_data(new_value, x0=x0, x1=x1)
         if x is not None:
             if not np.isreal(y).all():
                 self.curve.setData(x, self._magnitude(y))
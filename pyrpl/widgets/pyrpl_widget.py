@@ -2,7 +2,7 @@ from qtpy import QtCore, QtWidgets
 import sys
 from traceback import format_exception, format_exception_only
 import logging
-from .. import APP
+from .. import APP, LOOP_BACKEND
 
 
 
@@ -35,11 +35,12 @@ def patch_excepthook():
     EL.old_except_hook = sys.excepthook
     sys.excepthook = EL.display_exception
 
-TIMER = QtCore.QTimer()
-TIMER.setSingleShot(True)
-TIMER.setInterval(0)
-TIMER.timeout.connect(patch_excepthook)
-TIMER.start()
+if LOOP_BACKEND == 'qt':  # there is no gui with other loop backends
+    TIMER = QtCore.QTimer()
+    TIMER.setSingleShot(True)
+    TIMER.setInterval(0)
+    TIMER.timeout.connect(patch_excepthook)
+    TIMER.start()
 
 
 class LogHandler(QtCore.QObject, logging.Handler):
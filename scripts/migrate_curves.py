@@ -0,0 +1,11 @@
+"""
+Script to convert all curves saved in the legacy pickle format (.dat files
+in the curve directory of pyrpl) into the current binary format.
+
+Type python migrate_curves.py
+"""
+from pyrpl.curvedb import CurveDB
+
+if __name__ == '__main__':
+    pks = CurveDB.migrate()
+    print("Converted %d curves in %s." % (len(pks), CurveDB._dirname))